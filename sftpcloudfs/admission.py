@@ -0,0 +1,248 @@
+#!/usr/bin/python
+"""
+Admission control of the sessions.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import errno
+import json
+import os
+import select
+import socket
+import threading
+from time import time
+
+import paramiko
+
+__all__ = ['AdmissionServer', 'Admission']
+
+
+class _Waiter(object):
+    """A session waiting to be admitted, or admitted until its socket is closed."""
+
+    def __init__(self, sock, seq):
+        self.sock = sock
+        self.seq = seq
+        self.buffer = ""
+        self.user = None
+        self.ip = None
+        self.deadline = None
+        self.admitted = False
+
+
+class AdmissionServer(object):
+    """
+    Session limits of the server, enforced by the server process.
+
+    The forked processes ask for a session slot with Admission through the
+    UNIX socket at `path`, and keep the connection open while the session
+    lasts; closing it (even if the process dies) releases the slot.
+
+    A session is admitted if its user has less than `per_user` sessions,
+    its IP address less than `per_ip`, and there are less than `total`
+    sessions (0 is no limit). Otherwise it waits up to `timeout` seconds;
+    when a slot is released the waiting sessions of the users with less
+    sessions are admitted first, in order of arrival.
+
+    The requests are served by a single thread, started by start() once the
+    server runs as its final user.
+    """
+
+    def __init__(self, path, per_user=0, per_ip=0, total=0, timeout=10.0):
+        self.path = path
+        self.per_user = per_user
+        self.per_ip = per_ip
+        self.total = total
+        self.timeout = timeout
+        self.log = paramiko.util.get_logger("paramiko")
+        self.sock = None
+        self.seq = 0
+        # socket: _Waiter
+        self.clients = {}
+        self.users = {}
+        self.ips = {}
+        self.active = 0
+
+    def start(self):
+        """Listen on the socket and serve the requests in a background thread."""
+        try:
+            os.unlink(self.path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(128)
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stop listening and remove the socket."""
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def serve(self):
+        while True:
+            listener = self.sock
+            if listener is None:
+                return
+            deadlines = [waiter.deadline for waiter in self.clients.values() if waiter.deadline]
+            timeout = max(0, min(deadlines) - time()) if deadlines else None
+            try:
+                readable, _, _ = select.select([listener] + self.clients.keys(), [], [], timeout)
+            except (select.error, socket.error), ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                if self.sock is None:
+                    return
+                raise
+            for sock in readable:
+                if sock is listener:
+                    self._accept(listener)
+                else:
+                    self._read(self.clients[sock])
+            self._expire()
+            self._admit()
+
+    def _accept(self, listener):
+        try:
+            sock, _ = listener.accept()
+        except socket.error:
+            return
+        self.seq += 1
+        self.clients[sock] = _Waiter(sock, self.seq)
+
+    def _read(self, waiter):
+        try:
+            data = waiter.sock.recv(4096)
+        except socket.error:
+            data = ""
+        if not data:
+            self._remove(waiter)
+            return
+        if waiter.user is not None:
+            # nothing else is expected once the request is read
+            return
+        waiter.buffer += data
+        if "\n" not in waiter.buffer:
+            if len(waiter.buffer) > 4096:
+                self._remove(waiter)
+            return
+        try:
+            request = json.loads(waiter.buffer.split("\n", 1)[0])
+            waiter.user, waiter.ip = request["user"], request["ip"]
+        except (ValueError, KeyError, TypeError):
+            self.log.warning("admission: invalid request")
+            self._remove(waiter)
+            return
+        waiter.buffer = ""
+        waiter.deadline = time() + self.timeout
+
+    def _remove(self, waiter):
+        del self.clients[waiter.sock]
+        waiter.sock.close()
+        if waiter.admitted:
+            self.active -= 1
+            for counts, key in ((self.users, waiter.user), (self.ips, waiter.ip)):
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
+
+    def _reply(self, waiter, response):
+        try:
+            waiter.sock.sendall(json.dumps(response) + "\n")
+        except socket.error:
+            self._remove(waiter)
+            return False
+        return True
+
+    def _reason(self, waiter):
+        """Return why waiter can't be admitted now, or None if it can."""
+        if self.total and self.active >= self.total:
+            return "too many sessions"
+        if self.per_user and self.users.get(waiter.user, 0) >= self.per_user:
+            return "too many sessions for the user"
+        if self.per_ip and self.ips.get(waiter.ip, 0) >= self.per_ip:
+            return "too many sessions from the address"
+        return None
+
+    def _expire(self):
+        now = time()
+        for waiter in self.clients.values():
+            if waiter.deadline and waiter.deadline <= now:
+                if self._reply(waiter, dict(admitted=False, reason=self._reason(waiter) or "timeout")):
+                    self._remove(waiter)
+
+    def _admit(self):
+        waiting = [waiter for waiter in self.clients.values() if waiter.deadline]
+        waiting.sort(key=lambda waiter: (self.users.get(waiter.user, 0), waiter.seq))
+        for waiter in waiting:
+            if self.total and self.active >= self.total:
+                break
+            if self._reason(waiter):
+                continue
+            if not self._reply(waiter, dict(admitted=True)):
+                continue
+            waiter.deadline = None
+            waiter.admitted = True
+            self.active += 1
+            self.users[waiter.user] = self.users.get(waiter.user, 0) + 1
+            self.ips[waiter.ip] = self.ips.get(waiter.ip, 0) + 1
+
+
+class Admission(object):
+    """Client of the AdmissionServer at path."""
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+
+    def acquire(self, user, ip):
+        """
+        Wait for a session slot for user from ip.
+
+        Return (sock, None) if admitted, where closing sock releases the
+        slot, or (None, reason) if not.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # the server replies once the session is admitted or its time is up
+            sock.settimeout(self.timeout + 5.0)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(dict(user=user, ip=ip)) + "\n")
+            line = sock.makefile("r").readline()
+            response = json.loads(line) if line else dict(reason="no response")
+        except:
+            sock.close()
+            raise
+        if not response.get("admitted"):
+            sock.close()
+            return None, response.get("reason")
+        sock.settimeout(None)
+        return sock, None
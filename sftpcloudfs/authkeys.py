@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""
+Authorized public keys.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import binascii
+import logging
+import os
+import shlex
+import sqlite3
+import threading
+from base64 import b64decode, b64encode
+from hashlib import sha256
+
+from ftpcloudfs.utils import smart_str
+
+__all__ = ['fingerprint', 'AuthorizedKeys', 'FileAuthorizedKeys', 'SQLiteAuthorizedKeys']
+
+
+def fingerprint(blob):
+    """Return the fingerprint of a public key blob, as shown by ssh-keygen -l."""
+    return "SHA256:%s" % b64encode(sha256(blob).digest()).rstrip("=")
+
+
+class AuthorizedKeys(object):
+    """
+    Store of the public keys allowed to log in.
+
+    Each key is allowed for a username, and it's mapped to the credentials
+    used to access the Object Storage: a dictionary with either the
+    `password` of the user, or the `url` and `token` of an already
+    authenticated session.
+    """
+
+    def get(self, username, key):
+        """Return the credentials for username and key (a paramiko PKey), or None if not allowed."""
+        return self.lookup(smart_str(username), fingerprint(key.asbytes()))
+
+    def lookup(self, username, fingerprint):
+        """Return the credentials for username and a key fingerprint, or None if not found."""
+        raise NotImplementedError()
+
+    @staticmethod
+    def credentials(password=None, url=None, token=None):
+        """Return the credentials dictionary, or None if incomplete."""
+        if password:
+            return dict(password=smart_str(password))
+        if url and token:
+            return dict(url=smart_str(url), token=smart_str(token))
+        return None
+
+
+class FileAuthorizedKeys(AuthorizedKeys):
+    """
+    Authorized keys in a text file.
+
+    One key per line, similar to OpenSSH's authorized_keys, followed by the
+    credentials:
+
+        username key-type base64-key password=secret
+        username key-type base64-key url=storage-url token=auth-token
+
+    Empty lines and lines starting with # are ignored, and values can be
+    quoted. The file is loaded again when it changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.version = None
+        self.keys = {}
+        self.reload()
+
+    def reload(self):
+        """Load the file if it changed since it was loaded."""
+        st = os.stat(self.path)
+        version = (st.st_ino, st.st_size, st.st_mtime)
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            self.keys = self.parse(self.path)
+            self.version = version
+        logging.debug("authorized keys: loaded %s keys from %r" % (len(self.keys), self.path))
+
+    @classmethod
+    def parse(cls, path):
+        """Return a dictionary of {(username, fingerprint): credentials} from the file at path."""
+        keys = {}
+        with open(path) as fd:
+            for number, line in enumerate(fd, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    fields = shlex.split(line)
+                    username, _, blob = fields[:3]
+                    options = dict(field.split("=", 1) for field in fields[3:])
+                    key = fingerprint(b64decode(blob))
+                except (ValueError, IndexError, TypeError, binascii.Error):
+                    logging.warning("authorized keys: %r line %s: invalid entry, ignored" % (path, number))
+                    continue
+                credentials = cls.credentials(**dict((name, options.get(name))
+                                                     for name in ("password", "url", "token")))
+                if not credentials:
+                    logging.warning("authorized keys: %r line %s: no credentials, ignored" % (path, number))
+                    continue
+                keys[(username, key)] = credentials
+        return keys
+
+    def lookup(self, username, fingerprint):
+        try:
+            self.reload()
+        except EnvironmentError, ex:
+            # keep using the keys loaded before
+            logging.warning("authorized keys: failed to load %r: %s" % (self.path, ex))
+        return self.keys.get((username, fingerprint))
+
+
+class SQLiteAuthorizedKeys(AuthorizedKeys):
+    """
+    Authorized keys in a SQLite database.
+
+    The keys are found by their fingerprint (see the fingerprint function)
+    in the authorized_keys table, created if it doesn't exist. Changes to
+    the table are used by the next login.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS authorized_keys (
+        fingerprint TEXT NOT NULL,
+        username TEXT NOT NULL,
+        password TEXT,
+        url TEXT,
+        token TEXT,
+        PRIMARY KEY (fingerprint, username)
+    )"""
+
+    def __init__(self, path):
+        self.path = path
+        db = self._connect()
+        try:
+            with db:
+                db.execute(self.SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def lookup(self, username, fingerprint):
+        # a connection per lookup, they can't be shared between threads or processes
+        db = self._connect()
+        try:
+            row = db.execute("SELECT password, url, token FROM authorized_keys "
+                             "WHERE fingerprint = ? AND username = ?",
+                             (fingerprint, username.decode("utf-8", "replace"))).fetchone()
+        finally:
+            db.close()
+        return self.credentials(*row) if row else None
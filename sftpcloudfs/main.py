@@ -24,11 +24,18 @@ THE SOFTWARE.
 
 """
 
+import errno
 import os
 import pwd
+import select
+import shutil
 import signal
+import socket
 import sys
+import tempfile
 import logging
+import multiprocessing
+from time import time
 from logging.handlers import SysLogHandler
 from ConfigParser import RawConfigParser, ParsingError
 from optparse import OptionParser
@@ -40,6 +47,14 @@ from sftpcloudfs.constants import version, project_url, config_file, default_ks_
     default_ks_tenant_separator, default_ks_endpoint_type
 from ftpcloudfs.fs import ObjectStorageFS
 
+# file descriptors passed to a server process taking over from a running one
+LISTEN_FD_ENV = "SFTPCLOUDFS_LISTEN_FD"
+METRICS_FD_ENV = "SFTPCLOUDFS_METRICS_FD"
+READY_FD_ENV = "SFTPCLOUDFS_READY_FD"
+
+class Handover(Exception):
+    """The server was asked to hand over to a new process (HUP signal)."""
+
 class PIDFile(object):
     """
     PID file implementation using a context manager.
@@ -47,10 +62,13 @@ class PIDFile(object):
     Entering the context acquires the lock, raising OSError if the file exists
     and it's already locked. Leaving the context cleans the PID file.
 
+    With takeover the file of the process being taken over is replaced.
+
     Some methods are implemented for compatibility with lockfile and python-daemon.
     """
-    def __init__(self, pidfile=None):
+    def __init__(self, pidfile=None, takeover=False):
         self.pidfile = pidfile
+        self.takeover = takeover
         self._fd = None
 
     def __enter__(self):
@@ -61,7 +79,8 @@ class PIDFile(object):
 
     def acquire(self):
         pid = os.getpid()
-        fd = os.open(self.pidfile, (os.O_CREAT|os.O_EXCL|os.O_WRONLY), 0644)
+        flags = os.O_TRUNC if self.takeover else os.O_EXCL
+        fd = os.open(self.pidfile, (os.O_CREAT|flags|os.O_WRONLY), 0644)
         self._fd = os.fdopen(fd, "w")
         self._fd.write("%s\n" % pid)
         self._fd.flush()
@@ -84,11 +103,28 @@ class PIDFile(object):
             os.remove(self.pidfile)
             self._fd = None
 
+    def handover(self):
+        """Leave the file to the process that took over."""
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
 class Main(object):
+
+    # seconds to wait for a new server process to take over
+    handover_timeout = 60
+
     def __init__(self):
         """Parse configuration and CLI options."""
         global config_file
 
+        # used to start a new server process on HUP
+        self.cwd = os.getcwd()
+        self.argv = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+        self.inherited = dict((name, int(os.environ.pop(name)))
+                              for name in (LISTEN_FD_ENV, METRICS_FD_ENV, READY_FD_ENV)
+                              if name in os.environ)
+
         # look for an alternative configuration file
         alt_config_file = False
         # used to show errors before we actually start parsing stuff
@@ -114,6 +150,9 @@ class Main(object):
                                   'server-ident': 'sftpcloudfs_%s' % version,
                                   'memcache': None,
                                   'max-children': "20",
+                                  'prefork-workers': "0",
+                                  'prefork-connections': "50",
+                                  'prefork-max-requests': "0",
                                   'auth-timeout': "60",
                                   'negotiation-timeout': "0",
                                   'keepalive': "0",
@@ -128,6 +167,46 @@ class Main(object):
                                   'gid': None,
                                   'split-large-files': "0",
                                   'hide-part-dir': "no",
+                                  'parallel-upload-workers': "0",
+                                  'parallel-download-workers': "0",
+                                  'parallel-download-size': "8",
+                                  'write-buffer-size': "8",
+                                  'write-buffer-total': "64",
+                                  'storage-pool-size': "4",
+                                  'storage-pool-idle-timeout': "30",
+                                  'token-cache': "memcache",
+                                  'token-cache-dir': None,
+                                  'token-cache-ttl': "3600",
+                                  'token-cache-salt': None,
+                                  'authorized-keys': "no",
+                                  'authorized-keys-path': None,
+                                  'max-sessions': "0",
+                                  'max-sessions-per-user': "0",
+                                  'max-sessions-per-ip': "0",
+                                  'admission-timeout': "10",
+                                  'session-upload-limit': "0",
+                                  'session-download-limit': "0",
+                                  'user-upload-limit': "0",
+                                  'user-download-limit': "0",
+                                  'upload-limit': "0",
+                                  'download-limit': "0",
+                                  'metrics-address': None,
+                                  'metadata-cache-size': "10000",
+                                  'metadata-cache-ttl': "10",
+                                  'rename-workers': "8",
+                                  'remove-batch-window': "0.005",
+                                  'scp-prefetch-workers': "4",
+                                  'scp-prefetch-memory': "16",
+                                  'scp-receive-buffer': "4",
+                                  'scp-chunk-size': "64",
+                                  'scp-timeout': "30",
+                                  'sftp-read-chunk-size': "64",
+                                  'ssh-window-size': "2048",
+                                  'ssh-max-window-size': "0",
+                                  'ssh-max-packet-size': "32",
+                                  'trace-sample': "0",
+                                  'trace-ops': None,
+                                  'drain-timeout': "0",
                                   # keystone auth support
                                   'keystone-auth': False,
                                   'keystone-auth-version': '2.0',
@@ -311,8 +390,8 @@ class Main(object):
                 parser.error("memcache: invalid server address, ip:port expected")
 
         if options.pid_file:
-            self.pidfile = PIDFile(options.pid_file)
-            if self.pidfile.is_locked():
+            self.pidfile = PIDFile(options.pid_file, takeover=READY_FD_ENV in self.inherited)
+            if not self.pidfile.takeover and self.pidfile.is_locked():
                 parser.error("pid-file found: %s\nIs the server already running?" % options.pid_file)
         else:
             self.pidfile = None
@@ -322,6 +401,36 @@ class Main(object):
         except ValueError:
             parser.error('max-children: invalid value, integer expected')
 
+        prefork_workers = config.get('sftpcloudfs', 'prefork-workers')
+        try:
+            if prefork_workers.lower() == 'auto':
+                options.prefork_workers = multiprocessing.cpu_count()
+            else:
+                options.prefork_workers = int(prefork_workers)
+        except NotImplementedError:
+            parser.error('prefork-workers: the number of CPUs is unknown, integer expected')
+        except ValueError:
+            parser.error('prefork-workers: invalid value, integer or auto expected')
+
+        if options.prefork_workers < 0:
+            parser.error('prefork-workers: invalid value')
+
+        try:
+            options.prefork_connections = int(config.get('sftpcloudfs', 'prefork-connections'))
+        except ValueError:
+            parser.error('prefork-connections: invalid value, integer expected')
+
+        if options.prefork_connections <= 0:
+            parser.error('prefork-connections: invalid value')
+
+        try:
+            options.prefork_max_requests = int(config.get('sftpcloudfs', 'prefork-max-requests'))
+        except ValueError:
+            parser.error('prefork-max-requests: invalid value, integer expected')
+
+        if options.prefork_max_requests < 0:
+            parser.error('prefork-max-requests: invalid value')
+
         try:
             options.auth_timeout = int(config.get('sftpcloudfs', 'auth-timeout'))
         except ValueError:
@@ -362,6 +471,62 @@ class Main(object):
 
         options.hide_part_dir = config.getboolean('sftpcloudfs', 'hide-part-dir')
 
+        try:
+            options.parallel_upload_workers = int(config.get('sftpcloudfs', 'parallel-upload-workers'))
+        except ValueError:
+            parser.error('parallel-upload-workers: invalid value, integer expected')
+
+        if options.parallel_upload_workers < 0:
+            parser.error('parallel-upload-workers: invalid value')
+
+        try:
+            options.parallel_download_workers = int(config.get('sftpcloudfs', 'parallel-download-workers'))
+        except ValueError:
+            parser.error('parallel-download-workers: invalid value, integer expected')
+
+        if options.parallel_download_workers < 0:
+            parser.error('parallel-download-workers: invalid value')
+
+        try:
+            options.parallel_download_size = int(config.get('sftpcloudfs', 'parallel-download-size'))*10**6
+        except ValueError:
+            parser.error('parallel-download-size: invalid size, integer expected')
+
+        if options.parallel_download_size <= 0:
+            parser.error('parallel-download-size: invalid size')
+
+        try:
+            options.write_buffer_size = int(config.get('sftpcloudfs', 'write-buffer-size'))*10**6
+        except ValueError:
+            parser.error('write-buffer-size: invalid size, integer expected')
+
+        if options.write_buffer_size < 0:
+            parser.error('write-buffer-size: invalid size')
+
+        try:
+            options.write_buffer_total = int(config.get('sftpcloudfs', 'write-buffer-total'))*10**6
+        except ValueError:
+            parser.error('write-buffer-total: invalid size, integer expected')
+
+        if options.write_buffer_total < 0:
+            parser.error('write-buffer-total: invalid size')
+
+        try:
+            options.storage_pool_size = int(config.get('sftpcloudfs', 'storage-pool-size'))
+        except ValueError:
+            parser.error('storage-pool-size: invalid value, integer expected')
+
+        if options.storage_pool_size < 0:
+            parser.error('storage-pool-size: invalid value')
+
+        try:
+            options.storage_pool_idle_timeout = int(config.get('sftpcloudfs', 'storage-pool-idle-timeout'))
+        except ValueError:
+            parser.error('storage-pool-idle-timeout: invalid value, integer expected')
+
+        if options.storage_pool_idle_timeout <= 0:
+            parser.error('storage-pool-idle-timeout: invalid value')
+
         if options.keystone:
             keystone_keys = ('auth_version', 'region_name', 'tenant_separator', 'domain_separator', 'service_type', 'endpoint_type')
             options.keystone = dict((key, getattr(options, key)) for key in keystone_keys)
@@ -384,6 +549,208 @@ class Main(object):
                 except KeyError:
                     parser.error("gid: Invalid gid: %s" % options.gid)
 
+        options.token_cache = config.get('sftpcloudfs', 'token-cache').lower()
+        if options.token_cache not in ('memcache', 'broker', 'file', 'no'):
+            parser.error('token-cache: invalid value, memcache, broker, file or no expected')
+
+        if options.token_cache == 'memcache' and not options.memcache:
+            options.token_cache = 'broker'
+
+        try:
+            options.token_cache_ttl = int(config.get('sftpcloudfs', 'token-cache-ttl'))
+        except ValueError:
+            parser.error('token-cache-ttl: invalid value, integer expected')
+
+        if options.token_cache_ttl <= 0:
+            parser.error('token-cache-ttl: invalid value')
+
+        options.token_cache_salt = config.get('sftpcloudfs', 'token-cache-salt')
+        options.token_cache_dir = config.get('sftpcloudfs', 'token-cache-dir')
+        self.token_cache_tmpdir = None
+        if options.token_cache in ('file', 'broker') and not options.token_cache_dir:
+            self.token_cache_tmpdir = options.token_cache_dir = tempfile.mkdtemp(prefix="sftpcloudfs-tokens-")
+            if options.uid or options.gid:
+                os.chown(options.token_cache_dir, options.uid or -1, options.gid or -1)
+
+        options.authorized_keys = config.get('sftpcloudfs', 'authorized-keys').lower()
+        if options.authorized_keys not in ('file', 'sqlite', 'no'):
+            parser.error('authorized-keys: invalid value, file, sqlite or no expected')
+
+        options.authorized_keys_path = config.get('sftpcloudfs', 'authorized-keys-path')
+        if options.authorized_keys != 'no':
+            if not options.authorized_keys_path:
+                parser.error('authorized-keys-path: a path is required with authorized-keys')
+            if options.authorized_keys == 'file' and not os.path.isfile(options.authorized_keys_path):
+                parser.error('authorized-keys-path: file not found')
+
+        for name in ('max-sessions', 'max-sessions-per-user', 'max-sessions-per-ip'):
+            try:
+                value = int(config.get('sftpcloudfs', name))
+            except ValueError:
+                parser.error('%s: invalid value, integer expected' % name)
+            if value < 0:
+                parser.error('%s: invalid value' % name)
+            setattr(options, name.replace('-', '_'), value)
+
+        try:
+            options.admission_timeout = float(config.get('sftpcloudfs', 'admission-timeout'))
+        except ValueError:
+            parser.error('admission-timeout: invalid value, number expected')
+
+        if options.admission_timeout < 0:
+            parser.error('admission-timeout: invalid value')
+
+        for name in ('session-upload-limit', 'session-download-limit', 'user-upload-limit',
+                     'user-download-limit', 'upload-limit', 'download-limit'):
+            try:
+                value = int(config.get('sftpcloudfs', name))*1024
+            except ValueError:
+                parser.error('%s: invalid value, integer expected' % name)
+            if value < 0:
+                parser.error('%s: invalid value' % name)
+            setattr(options, name.replace('-', '_'), value)
+
+        # the socket of the admission control is in a directory only accessible by the server user
+        self.admission_tmpdir = options.admission_socket = None
+        if options.max_sessions or options.max_sessions_per_user or options.max_sessions_per_ip:
+            self.admission_tmpdir = tempfile.mkdtemp(prefix="sftpcloudfs-admission-")
+            options.admission_socket = os.path.join(self.admission_tmpdir, "admission.sock")
+            if options.uid or options.gid:
+                os.chown(self.admission_tmpdir, options.uid or -1, options.gid or -1)
+
+        options.metrics_address = None
+        metrics_address = config.get('sftpcloudfs', 'metrics-address')
+        if metrics_address:
+            host, _, port = metrics_address.rpartition(':')
+            try:
+                options.metrics_address = (host or "127.0.0.1", int(port))
+            except ValueError:
+                parser.error('metrics-address: invalid value, [ip:]port expected')
+
+        try:
+            options.metadata_cache_size = int(config.get('sftpcloudfs', 'metadata-cache-size'))
+        except ValueError:
+            parser.error('metadata-cache-size: invalid value, integer expected')
+
+        if options.metadata_cache_size < 0:
+            parser.error('metadata-cache-size: invalid value')
+
+        try:
+            options.metadata_cache_ttl = int(config.get('sftpcloudfs', 'metadata-cache-ttl'))
+        except ValueError:
+            parser.error('metadata-cache-ttl: invalid value, integer expected')
+
+        if options.metadata_cache_ttl <= 0:
+            parser.error('metadata-cache-ttl: invalid value')
+
+        try:
+            options.rename_workers = int(config.get('sftpcloudfs', 'rename-workers'))
+        except ValueError:
+            parser.error('rename-workers: invalid value, integer expected')
+
+        if options.rename_workers <= 0:
+            parser.error('rename-workers: invalid value')
+
+        try:
+            options.remove_batch_window = float(config.get('sftpcloudfs', 'remove-batch-window'))
+        except ValueError:
+            parser.error('remove-batch-window: invalid value, number expected')
+
+        if options.remove_batch_window < 0:
+            parser.error('remove-batch-window: invalid value')
+
+        try:
+            options.scp_prefetch_workers = int(config.get('sftpcloudfs', 'scp-prefetch-workers'))
+        except ValueError:
+            parser.error('scp-prefetch-workers: invalid value, integer expected')
+
+        if options.scp_prefetch_workers < 0:
+            parser.error('scp-prefetch-workers: invalid value')
+
+        try:
+            options.scp_prefetch_memory = int(config.get('sftpcloudfs', 'scp-prefetch-memory'))*10**6
+        except ValueError:
+            parser.error('scp-prefetch-memory: invalid size, integer expected')
+
+        if options.scp_prefetch_memory < 0:
+            parser.error('scp-prefetch-memory: invalid size')
+
+        try:
+            options.scp_receive_buffer = int(config.get('sftpcloudfs', 'scp-receive-buffer'))*10**6
+        except ValueError:
+            parser.error('scp-receive-buffer: invalid size, integer expected')
+
+        if options.scp_receive_buffer < 0:
+            parser.error('scp-receive-buffer: invalid size')
+
+        try:
+            options.scp_chunk_size = int(config.get('sftpcloudfs', 'scp-chunk-size'))*1024
+        except ValueError:
+            parser.error('scp-chunk-size: invalid size, integer expected')
+
+        if options.scp_chunk_size <= 0:
+            parser.error('scp-chunk-size: invalid size')
+
+        try:
+            options.scp_timeout = float(config.get('sftpcloudfs', 'scp-timeout'))
+        except ValueError:
+            parser.error('scp-timeout: invalid value, number expected')
+
+        if options.scp_timeout <= 0:
+            parser.error('scp-timeout: invalid value')
+
+        try:
+            options.sftp_read_chunk_size = int(config.get('sftpcloudfs', 'sftp-read-chunk-size'))*1024
+        except ValueError:
+            parser.error('sftp-read-chunk-size: invalid size, integer expected')
+
+        if options.sftp_read_chunk_size <= 0:
+            parser.error('sftp-read-chunk-size: invalid size')
+
+        try:
+            options.ssh_window_size = int(config.get('sftpcloudfs', 'ssh-window-size'))*1024
+        except ValueError:
+            parser.error('ssh-window-size: invalid size, integer expected')
+
+        if not 32*1024 <= options.ssh_window_size < 2**32:
+            parser.error('ssh-window-size: invalid size, it must be between 32 and 4194303')
+
+        try:
+            options.ssh_max_window_size = int(config.get('sftpcloudfs', 'ssh-max-window-size'))*1024
+        except ValueError:
+            parser.error('ssh-max-window-size: invalid size, integer expected')
+
+        if options.ssh_max_window_size and \
+                not options.ssh_window_size <= options.ssh_max_window_size < 2**32:
+            parser.error('ssh-max-window-size: invalid size, it must be between ssh-window-size and 4194303')
+
+        try:
+            options.ssh_max_packet_size = int(config.get('sftpcloudfs', 'ssh-max-packet-size'))*1024
+        except ValueError:
+            parser.error('ssh-max-packet-size: invalid size, integer expected')
+
+        if not 4*1024 <= options.ssh_max_packet_size <= 256*1024:
+            parser.error('ssh-max-packet-size: invalid size, it must be between 4 and 256')
+
+        try:
+            options.trace_sample = float(config.get('sftpcloudfs', 'trace-sample'))
+        except ValueError:
+            parser.error('trace-sample: invalid value, number expected')
+
+        if not 0 <= options.trace_sample <= 1:
+            parser.error('trace-sample: invalid value, it must be between 0 and 1')
+
+        trace_ops = config.get('sftpcloudfs', 'trace-ops')
+        options.trace_ops = [x.strip() for x in trace_ops.split(',') if x.strip()] if trace_ops else None
+
+        try:
+            options.drain_timeout = float(config.get('sftpcloudfs', 'drain-timeout'))
+        except ValueError:
+            parser.error('drain-timeout: invalid value, number expected')
+
+        if options.drain_timeout < 0:
+            parser.error('drain-timeout: invalid value')
+
         self.options = options
 
     def setup_log(self):
@@ -418,16 +785,117 @@ class Main(object):
             self.log.setLevel(logging.INFO)
 
 
+    def inherited_socket(self, name, address):
+        """Return the listening socket passed as name if it's bound to address, or None."""
+        fd = self.inherited.get(name)
+        if fd is None:
+            return None
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        try:
+            bound = address and sock.getsockname() == (socket.gethostbyname(address[0]), address[1])
+        except socket.error:
+            bound = False
+        if not bound:
+            # the address changed, a new socket is used
+            sock.close()
+            return None
+        return sock
+
+    def request_handover(self, signum, frame):
+        raise Handover()
+
+    def handover(self, server):
+        """
+        Start a new server process, that reads the configuration again and
+        takes over the listening sockets.
+
+        Return True once the new process is serving, or False if it failed
+        to start.
+        """
+        fds = {LISTEN_FD_ENV: server.fileno()}
+        if server.metrics:
+            fds[METRICS_FD_ENV] = server.metrics.fileno()
+        ready, fds[READY_FD_ENV] = os.pipe()
+        env = dict(os.environ)
+        env.update((name, str(fd)) for name, fd in fds.items())
+
+        pid = os.fork()
+        if not pid:
+            try:
+                # only the sockets and the pipe are inherited
+                keep = sorted(set(fds.values()))
+                for low, high in zip([3] + [fd + 1 for fd in keep], keep + [os.sysconf("SC_OPEN_MAX")]):
+                    os.closerange(low, high)
+                try:
+                    # for relative paths in the arguments
+                    os.chdir(self.cwd)
+                except OSError:
+                    pass
+                os.execve(sys.executable, self.argv, env)
+            finally:
+                os._exit(127)
+
+        os.close(fds[READY_FD_ENV])
+        self.log.info("Starting a new server process (%s) to take over" % pid)
+        status = ""
+        try:
+            deadline = time() + self.handover_timeout
+            while not status:
+                try:
+                    readable, _, _ = select.select([ready], [], [], max(0, deadline - time()))
+                except select.error, ex:
+                    if ex.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not readable:
+                    break
+                status = os.read(ready, 64)
+                if not status:
+                    # the process exited
+                    break
+        finally:
+            os.close(ready)
+            if not status:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                os.waitpid(pid, 0)
+
+        if not status:
+            self.log.error("The new server process failed to start, the configuration is not reloaded")
+            if self.pidfile and self.pidfile.i_am_locking():
+                # the new process may have replaced the PID file
+                self.pidfile.handover()
+                self.pidfile.takeover = True
+                self.pidfile.acquire()
+            return False
+        return True
+
+    def ready(self):
+        """Tell the server process being taken over that this one is serving."""
+        fd = self.inherited.pop(READY_FD_ENV, None)
+        if fd is not None:
+            os.write(fd, "ready\n")
+            os.close(fd)
+
     def run(self):
         """Run the server."""
+        listen_socket = self.inherited_socket(LISTEN_FD_ENV, (self.options.bind_address, self.options.port))
+        metrics_socket = self.inherited_socket(METRICS_FD_ENV, self.options.metrics_address)
         server = ObjectStorageSFTPServer((self.options.bind_address, self.options.port),
                                           host_key=self.host_key,
                                           authurl=self.options.authurl,
                                           max_children=self.options.max_children,
+                                          prefork_workers=self.options.prefork_workers,
+                                          prefork_connections=self.options.prefork_connections,
+                                          prefork_max_requests=self.options.prefork_max_requests,
                                           keystone=self.options.keystone,
                                           no_scp=self.options.no_scp,
                                           split_size=self.options.split_size,
                                           hide_part_dir=self.options.hide_part_dir,
+                                          parallel_upload_workers=self.options.parallel_upload_workers,
                                           auth_timeout=self.options.auth_timeout,
                                           negotiation_timeout=self.options.negotiation_timeout,
                                           keepalive=self.options.keepalive,
@@ -435,6 +903,47 @@ class Main(object):
                                           secopts=self.options.secopts,
                                           server_ident=self.options.server_ident,
                                           storage_policy=self.options.storage_policy,
+                                          parallel_download_workers=self.options.parallel_download_workers,
+                                          parallel_download_size=self.options.parallel_download_size,
+                                          write_buffer_size=self.options.write_buffer_size,
+                                          write_buffer_total=self.options.write_buffer_total,
+                                          storage_pool_size=self.options.storage_pool_size,
+                                          storage_pool_idle_timeout=self.options.storage_pool_idle_timeout,
+                                          token_cache=self.options.token_cache,
+                                          token_cache_dir=self.options.token_cache_dir,
+                                          token_cache_ttl=self.options.token_cache_ttl,
+                                          token_cache_salt=self.options.token_cache_salt,
+                                          authorized_keys=self.options.authorized_keys,
+                                          authorized_keys_path=self.options.authorized_keys_path,
+                                          max_sessions=self.options.max_sessions,
+                                          max_sessions_per_user=self.options.max_sessions_per_user,
+                                          max_sessions_per_ip=self.options.max_sessions_per_ip,
+                                          admission_timeout=self.options.admission_timeout,
+                                          admission_socket=self.options.admission_socket,
+                                          session_upload_limit=self.options.session_upload_limit,
+                                          session_download_limit=self.options.session_download_limit,
+                                          user_upload_limit=self.options.user_upload_limit,
+                                          user_download_limit=self.options.user_download_limit,
+                                          upload_limit=self.options.upload_limit,
+                                          download_limit=self.options.download_limit,
+                                          metrics_address=self.options.metrics_address,
+                                          metadata_cache_size=self.options.metadata_cache_size,
+                                          metadata_cache_ttl=self.options.metadata_cache_ttl,
+                                          rename_workers=self.options.rename_workers,
+                                          remove_batch_window=self.options.remove_batch_window,
+                                          scp_prefetch_workers=self.options.scp_prefetch_workers,
+                                          scp_prefetch_memory=self.options.scp_prefetch_memory,
+                                          scp_receive_buffer=self.options.scp_receive_buffer,
+                                          scp_chunk_size=self.options.scp_chunk_size,
+                                          scp_timeout=self.options.scp_timeout,
+                                          sftp_read_chunk_size=self.options.sftp_read_chunk_size,
+                                          ssh_window_size=self.options.ssh_window_size,
+                                          ssh_max_window_size=self.options.ssh_max_window_size,
+                                          ssh_max_packet_size=self.options.ssh_max_packet_size,
+                                          trace_sample=self.options.trace_sample,
+                                          trace_ops=self.options.trace_ops,
+                                          listen_socket=listen_socket,
+                                          metrics_socket=metrics_socket,
                                           )
 
         dc = daemon.DaemonContext()
@@ -448,6 +957,12 @@ class Main(object):
 
         # FIXME: we don't know the fileno for Random open files, but they're  < 16
         dc.files_preserve = range(server.fileno(), 16)
+        if server.metrics:
+            dc.files_preserve.extend(server.metrics.filenos())
+        if READY_FD_ENV in self.inherited:
+            dc.files_preserve.append(self.inherited[READY_FD_ENV])
+            # the process being taken over is already detached
+            dc.detach_process = False
 
         if self.options.foreground:
             dc.detach_process = False
@@ -461,7 +976,24 @@ class Main(object):
                     self.log.warning("UID is 0, running as root is not recommended")
 
                 self.log.info("Listening on %s:%s" % (self.options.bind_address, self.options.port))
-                server.serve_forever()
+                signal.signal(signal.SIGHUP, self.request_handover)
+                while True:
+                    try:
+                        self.ready()
+                        server.serve_forever()
+                    except Handover:
+                        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                        if self.handover(server):
+                            break
+                        signal.signal(signal.SIGHUP, self.request_handover)
+
+                # the new process owns the PID file and serves the new connections
+                if self.pidfile:
+                    self.pidfile.handover()
+                self.log.info("Handed over, waiting for the connections in progress to finish...")
+                server.drain(self.options.drain_timeout)
+                server.server_close()
+                self.log.info("Terminating...")
             except (SystemExit, KeyboardInterrupt):
                 self.log.info("Terminating...")
                 if server.active_children:
@@ -469,6 +1001,12 @@ class Main(object):
                         os.kill(pid, signal.SIGTERM)
                 server.server_close()
 
+        if self.token_cache_tmpdir:
+            shutil.rmtree(self.token_cache_tmpdir, ignore_errors=True)
+
+        if self.admission_tmpdir:
+            shutil.rmtree(self.admission_tmpdir, ignore_errors=True)
+
         if self.pidfile and self.pidfile.i_am_locking():
             self.pidfile.release()
 
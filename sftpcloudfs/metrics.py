@@ -0,0 +1,263 @@
+#!/usr/bin/python
+"""
+Operation metrics exposed in the Prometheus text format.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import json
+import os
+import socket
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import paramiko
+
+__all__ = ['metrics', 'Metrics', 'MetricsServer']
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name: (type, help)
+METRICS = {
+    "sftpcloudfs_sftp_op_seconds": ("histogram", "Latency of the SFTP operations."),
+    "sftpcloudfs_sftp_op_errors_total": ("counter", "SFTP operations that returned an error."),
+    "sftpcloudfs_scp_op_seconds": ("histogram", "Latency of the SCP commands."),
+    "sftpcloudfs_scp_op_errors_total": ("counter", "SCP commands that failed."),
+    "sftpcloudfs_bytes_total": ("counter", "Bytes transferred to (in) and from (out) the clients."),
+    "sftpcloudfs_swift_request_seconds": ("histogram", "Latency of the requests to the Object Storage."),
+    "sftpcloudfs_auth_seconds": ("histogram", "Latency of the authentications."),
+    "sftpcloudfs_sessions_total": ("counter", "Client connections."),
+    "sftpcloudfs_sessions_active": ("gauge", "Client connections in progress."),
+    "sftpcloudfs_admission_wait_seconds": ("histogram", "Time the sessions waited to be admitted."),
+    "sftpcloudfs_admission_rejected_total": ("counter", "Sessions not admitted because of the session limits."),
+    "sftpcloudfs_shaping_wait_seconds": ("histogram", "Waits of the transfers limited by the bandwidth shaping."),
+}
+
+
+def _format_labels(labels, extra=None):
+    labels = list(labels)
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    escaped = ('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in labels)
+    return "{%s}" % ",".join(escaped)
+
+
+class Metrics(object):
+    """
+    Counters, gauges and latency histograms of the process.
+
+    Once enabled, a forked process starts with empty metrics (see atfork)
+    and sends them every `interval` seconds to the process that enabled
+    them, that adds them up and serves the totals (see MetricsServer).
+
+    The metrics are identified by their name and labels; recording a metric
+    when the metrics are disabled does nothing.
+    """
+
+    # seconds between the updates sent by a forked process
+    interval = 5.0
+
+    def __init__(self):
+        self.enabled = False
+        self.sock = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.flusher = None
+
+    def enable(self, sock):
+        """Enable the metrics, forked processes send them to sock."""
+        self.sock = sock
+        self.enabled = True
+
+    def atfork(self):
+        """
+        Reset the metrics in a new forked process.
+
+        Must be called before any other thread of the process records a
+        metric; it does nothing if called again in the same process.
+        """
+        if not self.enabled or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.flusher = threading.Thread(target=self._flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter (or gauge)."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record a latency in a histogram."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds > BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+
+    def flush(self):
+        """Send the metrics recorded since the last flush to the parent process."""
+        if not self.flusher or self.pid != os.getpid():
+            # not a forked process, these are the totals
+            return
+        with self.lock:
+            values, self.values = self.values, {}
+            histograms, self.histograms = self.histograms, {}
+        if not values and not histograms:
+            return
+        update = dict(values=values.items(), histograms=histograms.items())
+        try:
+            self.sock.send(json.dumps(update))
+        except socket.error, ex:
+            paramiko.util.get_logger("paramiko").warning("failed to send the metrics: %s" % ex)
+
+    def _flush_loop(self):
+        event = threading.Event()
+        while True:
+            event.wait(self.interval)
+            self.flush()
+
+    def merge(self, update):
+        """Add the metrics sent by a forked process."""
+        with self.lock:
+            for (name, labels), value in update["values"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.values[key] = self.values.get(key, 0) + value
+            for (name, labels), (buckets, total) in update["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = [buckets, total]
+                else:
+                    histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                    histogram[1] += total
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((key, (list(buckets), total)) for key, (buckets, total) in self.histograms.items())
+
+        lines = []
+        for name in sorted(METRICS):
+            kind, description = METRICS[name]
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if kind == "histogram":
+                for (metric, labels), (buckets, total) in histograms:
+                    if metric != name:
+                        continue
+                    count = 0
+                    for bound, value in zip(BUCKETS + ("+Inf",), buckets):
+                        count += value
+                        lines.append("%s_bucket%s %s" % (name, _format_labels(labels, ("le", bound)), count))
+                    lines.append("%s_sum%s %r" % (name, _format_labels(labels), total))
+                    lines.append("%s_count%s %s" % (name, _format_labels(labels), count))
+            else:
+                for (metric, labels), value in values:
+                    if metric == name:
+                        lines.append("%s%s %s" % (name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(HTTPServer):
+    """
+    HTTP server for the metrics at /metrics.
+
+    Creating the server enables the metrics; the forked processes send
+    their updates to the server process, that must call start() before
+    serving any connection. The listening socket can be given as `sock`.
+    """
+
+    # max size of an update
+    MAX_UPDATE = 256*1024
+
+    def __init__(self, address, sock=None):
+        HTTPServer.__init__(self, address, MetricsRequestHandler, bind_and_activate=sock is None)
+        if sock:
+            # taken over from the previous server process
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        self.receiver, sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        metrics.enable(sender)
+
+    def filenos(self):
+        """Return the file descriptors to keep open."""
+        return [self.fileno(), self.receiver.fileno(), metrics.sock.fileno()]
+
+    def start(self):
+        """Start collecting and serving the metrics in background threads."""
+        for target in (self.collect, self.serve_forever):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def collect(self):
+        log = paramiko.util.get_logger("paramiko")
+        while True:
+            try:
+                data = self.receiver.recv(self.MAX_UPDATE)
+                metrics.merge(json.loads(data))
+            except Exception:
+                log.exception("failed to process a metrics update")
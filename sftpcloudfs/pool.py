@@ -0,0 +1,222 @@
+#!/usr/bin/python
+"""
+Keep-alive connections to the Object Storage.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from urlparse import urlparse
+
+from swiftclient.client import Connection
+from ftpcloudfs.fs import ProxyConnection
+from sftpcloudfs.metrics import metrics
+
+__all__ = ['ConnectionPool', 'PooledConnection']
+
+
+def _discard(http_conn):
+    """
+    Close the idle sockets of a connection.
+
+    Only the session is closed, a response still being read (eg. a
+    streamed GET) is not affected.
+    """
+    _, conn = http_conn
+    conn.request_session.close()
+
+
+class ConnectionPool(object):
+    """
+    Pool of idle HTTP connections to the Object Storage.
+
+    The connections are kept per storage host, up to `size` per host, and
+    are discarded after `idle_timeout` seconds without use. Broken sockets
+    are detected and replaced when the connection is used again.
+
+    The pool belongs to a process; a forked process starts with an empty
+    pool instead of sharing the sockets of its parent.
+    """
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+
+    @staticmethod
+    def key(url):
+        """Return the key for the connections to url."""
+        parsed = urlparse(url)
+        return "%s://%s" % (parsed.scheme, parsed.netloc)
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            logging.debug("connection pool: new process, dropping inherited connections")
+            self.pid = os.getpid()
+            self.idle = {}
+
+    def get(self, key):
+        """Return an idle connection for key, or None if there's none available."""
+        expired = []
+        found = None
+        now = time.time()
+        with self.lock:
+            self._check_fork()
+            conns = self.idle.get(key, [])
+            while conns:
+                # the most recently used is more likely to be alive
+                when, http_conn = conns.pop()
+                if now - when < self.idle_timeout:
+                    found = http_conn
+                    break
+                expired.append(http_conn)
+        for http_conn in expired:
+            _discard(http_conn)
+        logging.debug("connection pool: get %r (%s, %s expired)" % (key, "hit" if found else "miss", len(expired)))
+        return found
+
+    def put(self, http_conn):
+        """Keep an idle connection, or close it if the pool is full."""
+        key = self.key(http_conn[1].url)
+        now = time.time()
+        with self.lock:
+            self._check_fork()
+            conns = self.idle.setdefault(key, [])
+            expired = [conn for conn in conns if now - conn[0] >= self.idle_timeout]
+            if expired:
+                conns[:] = [conn for conn in conns if now - conn[0] < self.idle_timeout]
+            if len(conns) < self.size:
+                conns.append((now, http_conn))
+                http_conn = None
+        for _, conn in expired:
+            _discard(conn)
+        if http_conn:
+            logging.debug("connection pool: full for %r" % key)
+            _discard(http_conn)
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for _, http_conn in conns:
+                _discard(http_conn)
+
+
+class PooledConnection(ProxyConnection):
+    """
+    ProxyConnection using the connection pool and the token cache.
+
+    Closing the connection returns the HTTP connection to the pool so the
+    next request can reuse it, instead of starting a new TCP (and TLS)
+    connection.
+    """
+
+    # set by the server, None disables the pool
+    pool = None
+    # set by the server, None disables the token cache
+    token_cache = None
+
+    def get_auth(self):
+        """
+        Perform the authentication using the token cache if available.
+
+        A cached token is used only once per connection: if it's requested
+        again (eg. because the token was rejected), it's obtained from the
+        auth service and the cache is updated.
+        """
+        if not self.token_cache or not (self.user and self.key):
+            return super(PooledConnection, self).get_auth()
+
+        domains = sorted((self.os_options or {}).items())
+        key = self.token_cache.key(self.authurl, self.auth_version, self.user, self.tenant_name,
+                                   repr(domains), self.key)
+        if not self.ignore_auth_cache:
+            try:
+                cache = self.token_cache.get(key)
+            except Exception, ex:
+                logging.warning("token cache failed: %s" % ex)
+                cache = None
+            if cache:
+                logging.debug("token cache hit, key=%s" % key)
+                self.ignore_auth_cache = True
+                return cache
+            logging.debug("token cache miss, key=%s" % key)
+
+        cache = super(PooledConnection, self).get_auth()
+        self.ignore_auth_cache = False
+        try:
+            self.token_cache.set(key, cache)
+        except Exception, ex:
+            logging.warning("token cache failed: %s" % ex)
+        return cache
+
+    def http_connection(self, url=None):
+        http_conn = None
+        if self.pool:
+            http_conn = self.pool.get(self.pool.key(url or self.url))
+        if http_conn is None:
+            http_conn = Connection.http_connection(self, url) if url else Connection.http_connection(self)
+            _, conn = http_conn
+            conn.request = self._forwarded(conn.request)
+        # requests may be made on behalf of a different client
+        http_conn[1].real_ip = self.real_ip
+        return http_conn
+
+    @staticmethod
+    def _forwarded(request):
+        """
+        Add the X-Forwarded-For header to the requests of the connection,
+        and record their latency in the metrics.
+        """
+        @wraps(request)
+        def wrapper(method, url, data=None, headers=None, **kwargs):
+            if headers is None:
+                headers = {}
+            real_ip = getattr(request.__self__, "real_ip", None)
+            if real_ip:
+                headers['X-Forwarded-For'] = real_ip
+            start = time.time()
+            status = "error"
+            try:
+                resp = request(method, url, data=data, headers=headers, **kwargs)
+                status = "%dxx" % (resp.status_code // 100)
+                return resp
+            finally:
+                metrics.observe("sftpcloudfs_swift_request_seconds", time.time()-start,
+                                method=method, status=status)
+        return wrapper
+
+    def close(self):
+        """Return the connection to the pool."""
+        if self.pool and self.http_conn and type(self.http_conn) is tuple and len(self.http_conn) > 1 \
+                and hasattr(self.http_conn[1], "request_session"):
+            self.pool.put(self.http_conn)
+            self.http_conn = None
+        else:
+            super(PooledConnection, self).close()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+"""
+Pre-forked worker processes for SocketServer servers.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import errno
+import os
+import signal
+import socket
+import threading
+from time import time, sleep
+
+import paramiko
+
+__all__ = ['PreforkingMixIn']
+
+
+class PreforkingMixIn(object):
+    """
+    Mix-in class to serve the requests from pre-forked worker processes.
+
+    The parent process forks `workers` processes that accept connections on
+    the shared listening socket, handling each connection in a thread, up to
+    `max_connections` at the same time. A worker stops accepting connections
+    after serving `max_requests` (0 for no limit), or when it gets a HUP
+    signal, and exits once the ones in progress are done; the parent
+    replaces any worker that exits.
+
+    With `workers` set to 0, serve_forever is the one of the next class.
+    """
+
+    workers = 0
+    max_connections = 50
+    max_requests = 0
+    active_children = None
+    draining = False
+
+    # minimum lifetime of a worker before it is replaced without delay
+    min_worker_lifetime = 1.0
+
+    def serve_forever(self, *args, **kwargs):
+        """Start the workers and replace them when they exit."""
+        if not self.workers:
+            return super(PreforkingMixIn, self).serve_forever(*args, **kwargs)
+
+        log = paramiko.util.get_logger("paramiko")
+        if self.active_children is None:
+            self.active_children = {}
+        while True:
+            while len(self.active_children) < self.workers:
+                self.spawn_worker()
+            try:
+                pid, status = os.wait()
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.active_children.pop(pid, None)
+            if started is None:
+                continue
+            if status:
+                log.warning("worker %s exited with status %s" % (pid, status))
+            if time() - started < self.min_worker_lifetime:
+                # don't spin if the workers can't start
+                sleep(self.min_worker_lifetime)
+
+    def spawn_worker(self):
+        """Fork a worker process."""
+        pid = os.fork()
+        if pid:
+            self.active_children[pid] = time()
+            return
+
+        status = 1
+        try:
+            self.active_children = None
+            signal.signal(signal.SIGHUP, self.stop_accepting)
+            self.worker_init()
+            self.serve_worker()
+            status = 0
+        except (SystemExit, KeyboardInterrupt):
+            status = 0
+        except:
+            paramiko.util.get_logger("paramiko").exception("worker %s failed" % os.getpid())
+        finally:
+            os._exit(status)
+
+    def worker_init(self):
+        """Called in a new worker process before serving any request."""
+        pass
+
+    def stop_accepting(self, signum=None, frame=None):
+        """Stop accepting connections in a worker (the HUP signal handler)."""
+        self.draining = True
+        self.socket.close()
+
+    def serve_worker(self):
+        """Accept and serve connections until max_requests are served."""
+        slots = threading.BoundedSemaphore(self.max_connections)
+        served = 0
+        while not self.draining and (not self.max_requests or served < self.max_requests):
+            slots.acquire()
+            if self.draining:
+                slots.release()
+                break
+            try:
+                request, client_address = self.get_request()
+            except socket.error:
+                slots.release()
+                continue
+            if not self.verify_request(request, client_address):
+                self.shutdown_request(request)
+                slots.release()
+                continue
+            thread = threading.Thread(target=self.process_request_thread,
+                                      args=(request, client_address, slots))
+            thread.daemon = True
+            thread.start()
+            served += 1
+
+        # let another worker take the new connections and finish ours
+        self.socket.close()
+        for _ in xrange(self.max_connections):
+            slots.acquire()
+
+    def drain(self, timeout=0):
+        """
+        Stop accepting connections and wait for the child processes to
+        finish the ones in progress.
+
+        The child processes still running after `timeout` seconds (0 for no
+        limit) are terminated.
+        """
+        log = paramiko.util.get_logger("paramiko")
+        self.socket.close()
+        children = self.active_children or {}
+        if self.workers:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGHUP)
+                except OSError:
+                    pass
+        deadline = time() + timeout if timeout else None
+        while children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno == errno.ECHILD:
+                    break
+                raise
+            if pid:
+                if isinstance(children, dict):
+                    children.pop(pid, None)
+                else:
+                    children.discard(pid)
+                continue
+            if deadline and time() > deadline:
+                log.warning("%s processes still running, terminating them" % len(children))
+                for pid in children:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                break
+            sleep(1.0)
+
+    def process_request_thread(self, request, client_address, slots):
+        """Serve a connection in a worker thread."""
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            slots.release()
@@ -29,8 +29,14 @@ import optparse
 import posixpath
 import socket
 import threading
+from collections import deque
+from time import time
 
+from swiftclient.client import ClientException
 from ftpcloudfs.fs import IOSError, parse_fspath
+from ftpcloudfs.utils import smart_str
+from sftpcloudfs.metrics import metrics
+from sftpcloudfs.storage import WorkerPool
 
 class SCPException(Exception):
     def __init__(self, status, message):
@@ -38,19 +44,165 @@ class SCPException(Exception):
         super(Exception, self).__init__(message)
 
 
+class SendPrefetch(object):
+    """
+    Listings and file data requested ahead of a recursive send.
+
+    While the sender walks the tree, the listings of the subdirectories and
+    the first `size` bytes of the files that come next are requested by a
+    pool of `workers` threads, keeping up to `memory` bytes of file data.
+
+    Anything not prefetched (or that failed) is requested by the sender as
+    usual.
+    """
+
+    def __init__(self, fs, workers, memory, size, log):
+        self.fs = fs
+        self.log = log
+        self.pool = WorkerPool(fs.conn, workers)
+        self.memory = memory
+        self.size = size
+        # entries of a listing to look ahead
+        self.ahead = workers * 4
+        self.listings = {}
+        self.files = {}
+
+    def listdir_with_stat(self, path):
+        """Return the (prefetched) directory list of path."""
+        job = self.listings.pop(path, None)
+        if job:
+            try:
+                return job.result()
+            except Exception, ex:
+                self.log.debug("SCP prefetch of %r failed: %s", path, ex)
+        return self.fs.listdir_with_stat(path)
+
+    def schedule(self, path, entries):
+        """
+        Prefetch the next entries (up to ahead) of the directory path.
+
+        The file data is requested in order, until the first subdirectory
+        as its files are sent first.
+        """
+        read_files = True
+        for name, entry_stat in entries:
+            subpath = path + "/" + name
+            if stat.S_ISDIR(entry_stat.st_mode):
+                read_files = False
+                if subpath not in self.listings and self.fs.can_list_using(subpath):
+                    self.listings[subpath] = self.pool.submit(self.fs.listdir_with_stat_using, subpath)
+            elif read_files and subpath not in self.files:
+                size = min(entry_stat.st_size, self.size)
+                if size > self.memory:
+                    break
+                self.memory -= size
+                container, obj = parse_fspath(self.fs.abspath(subpath))
+                self.files[subpath] = (self.pool.submit(self._read, smart_str(container), smart_str(obj), size),
+                                       size)
+
+    @staticmethod
+    def _read(conn, container, obj, size):
+        if not size:
+            return ""
+        try:
+            _, data = conn.get_object(container, obj, headers={"Range": "bytes=0-%d" % (size - 1)})
+        except ClientException, ex:
+            if ex.http_status == 416:
+                return ""
+            raise
+        return data
+
+    def read(self, path):
+        """Return the first bytes of the file path, or None if not prefetched."""
+        if path not in self.files:
+            return None
+        job, size = self.files.pop(path)
+        try:
+            return job.result()
+        except Exception, ex:
+            self.log.debug("SCP prefetch of %r failed: %s", path, ex)
+            return None
+        finally:
+            self.memory += size
+
+    def close(self):
+        for job in self.listings.values() + [job for job, _ in self.files.values()]:
+            job.cancelled = True
+        self.listings = {}
+        self.files = {}
+        self.pool.close()
+
+
+class ReceiveFile(object):
+    """
+    A file received by SCP, written by a WorkerPool thread.
+
+    The calls are queued in order to a pool of one thread; once one fails,
+    the rest are ignored and the error is kept in `error`.
+    """
+
+    def __init__(self, fs, path):
+        self.fs = fs
+        self.path = path
+        self.fd = None
+        self.error = None
+
+    def _call(self, func, *args):
+        if self.error is None:
+            try:
+                func(*args)
+            except Exception, ex:
+                self.error = ex
+
+    def _open(self, conn):
+        self.fd = self.fs.open_using(conn, self.path, 'w')
+
+    def _write(self, data):
+        self.fd.write(data)
+
+    def _close(self):
+        try:
+            self.fd.close()
+        finally:
+            self.fs.invalidate(self.path)
+
+    def open(self, conn):
+        self._call(self._open, conn)
+
+    def write(self, conn, data):
+        self._call(self._write, data)
+
+    def close(self, conn):
+        self._call(self._close)
+
+
 class SCPHandler(threading.Thread):
 
     CHUNK_SIZE = 64*1024
     TIMEOUT = 30.0 # seconds
 
-    def __init__(self, arguments, channel, fs, log):
+    # threads prefetching listings and files in recursive sends, 0 disables it
+    prefetch_workers = 4
+    # bytes of file data prefetched, in total and per file
+    prefetch_memory = 16*10**6
+    prefetch_size = 4*CHUNK_SIZE
+    # bytes of received data queued to be stored, 0 stores the files as they are received
+    receive_buffer = 4*10**6
+
+    def __init__(self, arguments, channel, fs, log, shaper=None):
         super(SCPHandler, self).__init__()
         self.log = log
+        self.shaper = shaper
         self.channel = channel
         self.channel.settimeout(self.TIMEOUT)
         self.fs = fs
         self.args = arguments
-        self.buffer = ""
+        self.prefetch = None
+        self.writer = None
+        # files being stored by the writer as (file, close job)
+        self.stored = deque()
+        # data received after the last record line
+        self.buffer = bytearray()
 
     @classmethod
     def get_argparser(cls):
@@ -82,6 +234,8 @@ class SCPHandler(threading.Thread):
         return parser
 
     def run(self):
+        start = time()
+        op = "unknown"
         try:
             self.args, self.paths = SCPHandler.get_argparser().parse_args(self.args)
             self.log.debug("SCP %r", self.args)
@@ -93,28 +247,48 @@ class SCPHandler(threading.Thread):
                 raise SCPException(4, "scp takes exactly one path")
 
             if self.args.copy_to:
-                self.receive()
+                op = "receive"
+                if self.receive_buffer:
+                    self.writer = WorkerPool(self.fs.conn, 1, max(1, self.receive_buffer // self.CHUNK_SIZE))
+                try:
+                    self.receive()
+                finally:
+                    if self.writer:
+                        self.writer.close()
+                self.check_stored(wait=True)
             elif self.args.copy_from:
+                op = "send"
                 path = self.paths[0]
                 try:
                     path_stat = self.fs.stat(path)
                 except IOSError, ex:
                     raise SCPException(1, ex)
 
-                self.send(path, path_stat)
+                if self.args.recursive and self.prefetch_workers and stat.S_ISDIR(path_stat.st_mode):
+                    self.prefetch = SendPrefetch(self.fs, self.prefetch_workers, self.prefetch_memory,
+                                                 self.prefetch_size, self.log)
+                try:
+                    self.send(path, path_stat)
+                finally:
+                    if self.prefetch:
+                        self.prefetch.close()
             else:
                 raise SCPException(4, "Missing -t or -f argument")
         except SCPException, ex:
             self.log.info("SCP reject: %s", ex)
+            metrics.inc("sftpcloudfs_scp_op_errors_total", op=op)
             self.send_status_and_close(msg=ex, status=ex.status)
         except socket.timeout:
             self.log.info("SCP timeout")
+            metrics.inc("sftpcloudfs_scp_op_errors_total", op=op)
             self.send_status_and_close(msg="%ss timeout" % self.TIMEOUT, status=1)
         except:
             self.log.exception("SCP internal exception")
+            metrics.inc("sftpcloudfs_scp_op_errors_total", op=op)
             self.send_status_and_close(msg="internal error", status=1)
         else:
             self.send_status_and_close()
+        metrics.observe("sftpcloudfs_scp_op_seconds", time()-start, op=op)
 
     def send_status_and_close(self, msg=None, status=0):
         try:
@@ -128,26 +302,38 @@ class SCPHandler(threading.Thread):
         finally:
             try:
                 self.channel.close()
-            except socket.error:
+            except (socket.error, EOFError):
+                # the client may be gone already
                 pass
 
     def recv(self, size):
+        """Return up to size bytes, the buffered data first."""
         if self.buffer:
-            result = self.buffer[:size]
-            self.buffer = self.buffer[size:]
+            if len(self.buffer) <= size:
+                result, self.buffer = str(self.buffer), bytearray()
+            else:
+                result = str(self.buffer[:size])
+                del self.buffer[:size]
             return result
 
         return self.channel.recv(size)
 
     def recv_line(self):
-        if '\n' not in self.buffer:
-            while True:
-                chunk = self.channel.recv(1024)
-                self.buffer += chunk
-                if '\n' in chunk:
-                    break
-
-        line, self.buffer = self.buffer.split('\n', 1)
+        start = 0
+        while True:
+            end = self.buffer.find('\n', start)
+            if end >= 0:
+                break
+            start = len(self.buffer)
+            chunk = self.channel.recv(self.CHUNK_SIZE)
+            if not chunk:
+                raise SCPException(1, "unexpected end of stream")
+            self.buffer.extend(chunk)
+
+        # skip the status sent by the client after the data of a file
+        skip = 1 if self.buffer.startswith('\x00') else 0
+        line = str(self.buffer[skip:end])
+        del self.buffer[:end + 1]
         return line
 
     def receive(self):
@@ -198,18 +384,33 @@ class SCPHandler(threading.Thread):
             # ACK this file record
             self.channel.send('\x00')
 
-            fd = self.fs.open(target_path, 'w')
-
-            bytes_sent = 0
-            while bytes_sent < size:
-                chunk = self.recv(self.CHUNK_SIZE)
-                chunk = chunk[:(size-bytes_sent)]
-                fd.write(chunk)
-                bytes_sent += len(chunk)
-
-            fd.close()
-            # ACK sending this file
-            self.channel.send('\x00')
+            if self.writer:
+                stored = ReceiveFile(self.fs, target_path)
+                self.writer.submit(stored.open)
+                write = lambda data: self.writer.submit(stored.write, data)
+            else:
+                fd = self.fs.open(target_path, 'w')
+                write = fd.write
+
+            # read only the file data, so the chunks don't need to be split
+            remaining = size
+            while remaining:
+                chunk = self.recv(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise SCPException(1, "unexpected end of stream")
+                if self.shaper:
+                    self.shaper.upload(len(chunk), "scp")
+                write(chunk)
+                remaining -= len(chunk)
+
+            if self.writer:
+                self.stored.append((stored, self.writer.submit(stored.close)))
+            else:
+                fd.close()
+                self.fs.invalidate(target_path)
+            metrics.inc("sftpcloudfs_bytes_total", size, protocol="scp", direction="in")
+            # ACK sending this file, the client may be told now that a previous one failed
+            self.send_ack(self.check_stored())
             #self.wait_for_ack()
 
         elif record[0] == 'D':
@@ -229,11 +430,41 @@ class SCPHandler(threading.Thread):
                 record = self.recv_line()
                 if record[0] == 'E':
                     # ACK this file record
-                    self.channel.send('\x00')
+                    self.send_ack(self.check_stored())
                     break
                 else:
                     self.receive_inner(target_path, record)
 
+    def check_stored(self, wait=False):
+        """
+        Return the error message for the files that failed to be stored
+        since the last check, or None.
+
+        The files are stored in order, the check stops at the first one not
+        stored yet unless wait is True. With wait, the errors raise an
+        SCPException instead.
+        """
+        errors = []
+        while self.stored and (wait or self.stored[0][1].event.is_set()):
+            stored, job = self.stored.popleft()
+            job.event.wait()
+            if stored.error:
+                self.log.info("SCP failed to store %s: %s", stored.path, stored.error)
+                errors.append("%s: %s" % (stored.path, stored.error))
+        if not errors:
+            return None
+        if wait:
+            raise SCPException(1, "; ".join(errors))
+        return "; ".join(errors)
+
+    def send_ack(self, error=None):
+        """Acknowledge a record, or report a (non fatal) error."""
+        if error:
+            metrics.inc("sftpcloudfs_scp_op_errors_total", op="receive")
+            self.channel.sendall('\x01scp: %s\n' % smart_str(error))
+        else:
+            self.channel.send('\x00')
+
     def send(self, path, path_stat):
         self.log.debug('About to send %s', path)
 
@@ -250,13 +481,27 @@ class SCPHandler(threading.Thread):
                                  posixpath.basename(path)))
             self.wait_for_ack()
 
-            fd = self.fs.open(path, 'r')
-            while True:
-                chunk = fd.read(self.CHUNK_SIZE)
-                if chunk:
-                    self.channel.sendall(chunk)
-                else:
-                    break
+            bytes_sent = 0
+            data = self.prefetch.read(path) if self.prefetch else None
+            if data:
+                if self.shaper:
+                    self.shaper.download(len(data), "scp")
+                self.channel.sendall(data)
+                bytes_sent = len(data)
+            if data is None or bytes_sent < path_stat.st_size:
+                fd = self.fs.open(path, 'r')
+                if bytes_sent:
+                    fd.seek(bytes_sent)
+                while True:
+                    chunk = fd.read(self.CHUNK_SIZE)
+                    if chunk:
+                        if self.shaper:
+                            self.shaper.download(len(chunk), "scp")
+                        self.channel.sendall(chunk)
+                        bytes_sent += len(chunk)
+                    else:
+                        break
+            metrics.inc("sftpcloudfs_bytes_total", bytes_sent, protocol="scp", direction="out")
 
             # signal the end of the transfer
             self.channel.send('\x00')
@@ -273,7 +518,13 @@ class SCPHandler(threading.Thread):
 
             self.wait_for_ack()
 
-            for subpath, subpath_stat in self.fs.listdir_with_stat(path):
+            if self.prefetch:
+                entries = self.prefetch.listdir_with_stat(path)
+            else:
+                entries = self.fs.listdir_with_stat(path)
+            for index, (subpath, subpath_stat) in enumerate(entries):
+                if self.prefetch:
+                    self.prefetch.schedule(path, entries[index:index + self.prefetch.ahead])
                 subpath = path + "/" + subpath
                 self.send(subpath, subpath_stat)
 
@@ -29,37 +29,83 @@ import logging
 import os
 import errno
 import shlex
-from time import time
+import signal
+from random import random
+from time import time, sleep
 import threading
+from collections import deque
 from SocketServer import StreamRequestHandler, ForkingTCPServer
 
 import paramiko
+from paramiko.sftp import CMD_REMOVE, CMD_CLOSE, CMD_NAME
 from Crypto import Random
 
-from ftpcloudfs.fs import ObjectStorageFS, ObjectStorageFD
+from ftpcloudfs.fs import ObjectStorageFD, IOSError
 from ftpcloudfs.utils import smart_str
+from sftpcloudfs.storage import ObjectStorageFS, ParallelReadFD, ParallelWriteFD
+from sftpcloudfs.pool import ConnectionPool, PooledConnection
+from sftpcloudfs.prefork import PreforkingMixIn
+from sftpcloudfs.tokencache import MemcacheTokenCache, FileTokenCache, BrokerTokenCache, TokenBroker
+from sftpcloudfs.authkeys import fingerprint, FileAuthorizedKeys, SQLiteAuthorizedKeys
+from sftpcloudfs.admission import AdmissionServer, Admission
+from sftpcloudfs.shaping import Shaping
+from sftpcloudfs.metrics import metrics, MetricsServer
 from sftpcloudfs.scp import SCPHandler
 
 from functools import wraps
 from posixpath import basename
 
+class SFTPTrace(object):
+    """
+    Sampled tracing of the SFTP operations.
+
+    A random `sample` fraction of the operations (0 disables it) listed in
+    `ops` (all if empty) is logged at INFO level with its arguments, result
+    and latency, without enabling the debug logs.  Set by the server.
+    """
+    sample = 0.0
+    ops = ()
+
+
+def _short_repr(value, limit=64):
+    """repr() of value, summarizing long strings (eg. read or written data)."""
+    if isinstance(value, basestring) and len(value) > limit:
+        return "<%s bytes>" % len(value)
+    return repr(value)
+
+
+def _repr_call(args, kwargs):
+    params = [_short_repr(arg) for arg in args[1:]]
+    params.extend("%s=%s" % (key, _short_repr(value)) for key, value in kwargs.items())
+    return ", ".join(params)
+
+
 def return_sftp_errors(func):
     """
     Decorator to catch EnvironmentError~s and return SFTP error codes instead.
 
     Other exceptions are logged and processed as EIO errors.
+
+    The latency of the operation is recorded in the metrics. Calls are
+    logged only if the debug logs are enabled or the call is traced (see
+    SFTPTrace), so the arguments are not formatted otherwise.
     """
+    log = paramiko.util.get_logger("paramiko")
+    name = getattr(func, "func_name", "unknown")
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        log = paramiko.util.get_logger("paramiko")
-        name = getattr(func, "func_name", "unknown")
+        debug = log.isEnabledFor(logging.DEBUG)
+        trace = not debug and SFTPTrace.sample and (not SFTPTrace.ops or name in SFTPTrace.ops) \
+            and random() < SFTPTrace.sample
+        start = time()
         try:
-            log.debug("%s(%r,%r): enter" % (name, args, kwargs))
+            if debug:
+                log.debug("%s(%s): enter", name, _repr_call(args, kwargs))
             rc = func(*args, **kwargs)
         except BaseException, e:
             obj = args[0]
-            params = args[1:] if len(args) > 1 else ()
-            msg = "%s%r from %r: %s" % (name, params, obj.client_address, e)
+            msg = "%s(%s) from %r: %s" % (name, _repr_call(args, kwargs), obj.client_address, e)
             if isinstance(e, EnvironmentError):
                 log.info(msg)
                 error = e.errno
@@ -67,7 +113,14 @@ def return_sftp_errors(func):
                 log.exception("unexpected error: %s" % msg)
                 error = errno.EIO
             rc = paramiko.SFTPServer.convert_errno(error)
-        log.debug("%s: returns %r" % (name, rc))
+            metrics.inc("sftpcloudfs_sftp_op_errors_total", op=name)
+        elapsed = time() - start
+        metrics.observe("sftpcloudfs_sftp_op_seconds", elapsed, op=name)
+        if debug:
+            log.debug("%s: returns %s", name, _short_repr(rc))
+        elif trace:
+            log.info("trace: %s(%s) from %r returns %s in %.3fs", name, _repr_call(args, kwargs),
+                     args[0].client_address, _short_repr(rc), elapsed)
         return rc
     return wrapper
 
@@ -77,8 +130,9 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
     SFTPServerInterface implementation that exposes a ObjectStorageFS object.
     """
 
-    def __init__(self, server, fs, *args, **kwargs):
+    def __init__(self, server, fs, shaper=None, *args, **kwargs):
         self.fs = fs
+        self.shaper = shaper
         self.client_address = server.client_address
         self.log = paramiko.util.get_logger("paramiko")
         self.log.debug("%s: start filesystem interface" % self.__class__.__name__)
@@ -90,8 +144,7 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
 
     @return_sftp_errors
     def list_folder(self, path):
-        return [ paramiko.SFTPAttributes.from_stat(stat, smart_str(leaf))
-                 for leaf, stat in self.fs.listdir_with_stat(path) ]
+        return ListFolderHandle(self, self.fs.iter_listdir_with_stat(path))
 
     @return_sftp_errors
     def stat(self, path):
@@ -107,6 +160,21 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         self.fs.remove(path)
         return paramiko.SFTP_OK
 
+    @return_sftp_errors
+    def remove_many(self, paths):
+        """Remove several files, returning the SFTP result code for each path."""
+        if len(paths) == 1:
+            return [self.remove(paths[0])]
+        results = []
+        for path, error in zip(paths, self.fs.remove_many(paths)):
+            if error:
+                self.log.info("remove(%r) from %r: %s" % (path, self.client_address, error))
+                metrics.inc("sftpcloudfs_sftp_op_errors_total", op="remove")
+                results.append(paramiko.SFTPServer.convert_errno(error.errno))
+            else:
+                results.append(paramiko.SFTP_OK)
+        return results
+
     @return_sftp_errors
     def rename(self, oldpath, newpath):
         self.fs.rename(oldpath, newpath)
@@ -139,8 +207,28 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
 class SFTPHandle(paramiko.SFTPHandle):
     """
     Expose a ObjectStorageFD object to SFTP.
+
+    Reads are served through a window of already fetched data so pipelined
+    clients can issue requests out of order (or retry short reads) without
+    restarting the object stream; only offsets outside the window seek.
+
+    Writes ahead of the current position are kept in memory until the gap
+    before them is filled, with a limit per handle and per process. If a
+    gap is not filled when the handle is closed, the upload is aborted.
     """
 
+    # bytes kept in memory before the current stream position
+    READ_WINDOW = 4*1024*1024
+    # size of the chunks requested to the object stream
+    READ_CHUNK = 64*1024
+
+    # max bytes of out of order writes buffered per handle and per process
+    write_buffer_size = 8*10**6
+    write_buffer_total = 64*10**6
+
+    _write_buffer_lock = threading.Lock()
+    _write_buffer_used = 0
+
     def __init__(self, owner, path, flags):
         super(SFTPHandle, self).__init__(flags)
         self.log = paramiko.util.get_logger("paramiko")
@@ -160,49 +248,136 @@ class SFTPHandle(paramiko.SFTPHandle):
         if flags & os.O_APPEND:
             mode += "+"
 
-        # we need the file size for r & rw mode; this needs to be performed
-        # BEFORE open so the cache gets invalidated in write operations
-        try:
-            self._size = owner.fs.stat(path).st_size
-        except EnvironmentError:
-            self._size = 0
-
         # FIXME ignores os.O_CREAT, os.O_TRUNC, os.O_EXCL
+        # no need to stat the path: writes replace the object and reads get
+        # the size from the GET response
         self._file = owner.fs.open(path, mode)
         self._tell = 0
 
+        # read window: chunks of data ending at _tell
+        self._window = deque()
+        self._window_start = 0
+        self._window_size = 0
+
+        # out of order writes: offset -> data
+        self._pending = {}
+        self._pending_size = 0
+
     @property
     def client_address(self):
         return self.owner.client_address
 
     @return_sftp_errors
     def close(self):
-        self._file.close()
+        self._window.clear()
+        pending = self._pending_size
+        if pending:
+            self._release_pending()
+            # the data is incomplete, keep the object as it was
+            self._file.abort()
+            raise IOSError(errno.EIO, "%s: %s bytes were not written, missing data at offset %s"
+                           % (self.path, pending, self._tell))
+        try:
+            self._file.close()
+        finally:
+            if 'r' not in self._file.mode:
+                self.owner.fs.invalidate(self.path)
         return paramiko.SFTP_OK
 
     @return_sftp_errors
     def read(self, offset, length):
-        if offset != self._tell:
-            # this is not an "invalid offset" error
-            if offset > self._size:
+        if offset < self._window_start or offset > self._tell + self.READ_WINDOW:
+            # this is not an "invalid offset" error; if the size is not known
+            # yet, it will be checked when the data is requested
+            if self._file.size is not None and offset > self._file.size:
                 return paramiko.SFTP_EOF
             self._file.seek(offset)
-            self._tell = offset
-        data = self._file.read(length)
-        self._tell += len(data)
+            self._tell = self._window_start = offset
+            self._window.clear()
+            self._window_size = 0
+
+        # fetch up to the end of the request, keeping any skipped data
+        end = offset + length
+        while self._tell < end:
+            data = self._file.read(self.READ_CHUNK)
+            if not data:
+                break
+            self._window.append(data)
+            self._window_size += len(data)
+            self._tell += len(data)
+
+        data = self._read_window(offset, end)
+        metrics.inc("sftpcloudfs_bytes_total", len(data), protocol="sftp", direction="out")
+        if self.owner.shaper:
+            self.owner.shaper.download(len(data), "sftp")
+
+        # drop the data we don't need to keep
+        while self._window and self._window_size - len(self._window[0]) >= self.READ_WINDOW:
+            chunk = self._window.popleft()
+            self._window_size -= len(chunk)
+            self._window_start += len(chunk)
         return data
 
+    def _read_window(self, offset, end):
+        """Return the data between offset and end available in the read window."""
+        parts = []
+        pos = self._window_start
+        for chunk in self._window:
+            chunk_end = pos + len(chunk)
+            if chunk_end > offset:
+                parts.append(chunk[max(offset-pos, 0):end-pos])
+            pos = chunk_end
+            if pos >= end:
+                break
+        if len(parts) == 1:
+            return parts[0]
+        return "".join(parts)
+
     @return_sftp_errors
     def write(self, offset, data):
+        metrics.inc("sftpcloudfs_bytes_total", len(data), protocol="sftp", direction="in")
+        if self.owner.shaper:
+            self.owner.shaper.upload(len(data), "sftp")
         if offset != self._tell:
-            return paramiko.SFTP_OP_UNSUPPORTED
-            # FIXME self._file.seek(offset)
+            # we can't go back, but data ahead can wait for the gap to be filled
+            if offset < self._tell or not self._add_pending(offset, data):
+                return paramiko.SFTP_OP_UNSUPPORTED
+            return paramiko.SFTP_OK
+
+        self._write(data)
+        while self._tell in self._pending:
+            data = self._pending.pop(self._tell)
+            self._release_pending(len(data))
+            self._write(data)
+        return paramiko.SFTP_OK
+
+    def _write(self, data):
         self._file.write(data)
         self._tell += len(data)
-        # update the file size
-        if self._tell > self._size:
-            self._size = self._tell
-        return paramiko.SFTP_OK
+
+    def _add_pending(self, offset, data):
+        """Buffer an out of order write, return False if the limits don't allow it."""
+        size = len(data) - len(self._pending.get(offset, ""))
+        if self._pending_size + size > self.write_buffer_size:
+            self.log.warning("%s: write buffer full for handle (offset=%s)" % (self.path, offset))
+            return False
+        with self._write_buffer_lock:
+            if SFTPHandle._write_buffer_used + size > self.write_buffer_total:
+                self.log.warning("%s: write buffer full for process (offset=%s)" % (self.path, offset))
+                return False
+            SFTPHandle._write_buffer_used += size
+        self._pending[offset] = data
+        self._pending_size += size
+        return True
+
+    def _release_pending(self, size=None):
+        """Release size bytes (all by default) of the out of order writes buffer."""
+        if size is None:
+            size = self._pending_size
+            self._pending.clear()
+        self._pending_size -= size
+        with self._write_buffer_lock:
+            SFTPHandle._write_buffer_used -= size
 
     def stat(self):
         return self.owner.stat(self.path)
@@ -211,6 +386,240 @@ class SFTPHandle(paramiko.SFTPHandle):
         return paramiko.SFTP_OP_UNSUPPORTED
 
 
+class ListFolderHandle(paramiko.SFTPHandle):
+    """
+    Folder handle sending the directory list as it is retrieved.
+    """
+
+    # number of entries per READDIR response
+    BATCH_SIZE = 64
+
+    def __init__(self, owner, listing):
+        super(ListFolderHandle, self).__init__()
+        self.owner = owner
+        self._listing = listing
+
+    @property
+    def client_address(self):
+        return self.owner.client_address
+
+    @return_sftp_errors
+    def readdir(self):
+        """Return the next entries, retrieving the next page of the list if needed."""
+        files = []
+        for leaf, stat in self._listing:
+            files.append(paramiko.SFTPAttributes.from_stat(stat, smart_str(leaf)))
+            if len(files) >= self.BATCH_SIZE:
+                break
+        return files
+
+    def close(self):
+        self._listing = iter(())
+
+
+class SFTPServer(paramiko.SFTPServer):
+    """
+    SFTP subsystem supporting folder handles returned by list_folder,
+    that report the errors retrieving the list as SFTP errors.
+
+    Remove requests that the client sends without waiting for the previous
+    responses (including the ones received within remove_batch_window
+    seconds) are processed as a batch with remove_many. Each request still
+    gets its own response, before any later request is processed.
+
+    The result of closing a file is sent to the client (paramiko replies OK
+    regardless).
+    """
+
+    # seconds to wait for more remove requests, 0 disables the batching
+    remove_batch_window = 0.005
+    # max remove requests in a batch
+    remove_batch_size = 10000
+
+    def _process(self, t, request_number, msg):
+        if t == CMD_REMOVE and self.remove_batch_window and self.sock.recv_ready():
+            return self._process_removes(request_number, msg)
+        if t == CMD_CLOSE:
+            return self._close(request_number, msg)
+        return super(SFTPServer, self)._process(t, request_number, msg)
+
+    def _close(self, request_number, msg):
+        handle = msg.get_binary()
+        if handle in self.folder_table:
+            del self.folder_table[handle]
+            self._send_status(request_number, paramiko.SFTP_OK)
+        elif handle in self.file_table:
+            result = self.file_table.pop(handle).close()
+            # must be an error code if it's not None
+            self._send_status(request_number, paramiko.SFTP_OK if result is None else result)
+        else:
+            self._send_status(request_number, paramiko.SFTP_BAD_MESSAGE, "Invalid handle")
+
+    def _process_removes(self, request_number, msg):
+        batch = [(request_number, msg.get_text())]
+        pending = None
+        while len(batch) < self.remove_batch_size:
+            deadline = time() + self.remove_batch_window
+            while not self.sock.recv_ready() and time() < deadline:
+                # select would need a pipe per channel
+                sleep(0.001)
+            if not self.sock.recv_ready():
+                break
+            try:
+                t, data = self._read_packet()
+            except EOFError:
+                break
+            msg = paramiko.Message(data)
+            request_number = msg.get_int()
+            if t != CMD_REMOVE:
+                pending = (t, request_number, msg)
+                break
+            batch.append((request_number, msg.get_text()))
+
+        results = self.server.remove_many([path for _, path in batch])
+        if not isinstance(results, list):
+            # must be an error code
+            results = [results] * len(batch)
+        for (request_number, _), result in zip(batch, results):
+            self._send_status(request_number, result)
+        if pending:
+            super(SFTPServer, self)._process(*pending)
+
+    def _read_folder(self, request_number, folder):
+        files = folder.readdir()
+        if not isinstance(files, list):
+            # must be an error code
+            self._send_status(request_number, files)
+            return
+        if not files:
+            self._send_status(request_number, paramiko.SFTP_EOF)
+            return
+        msg = paramiko.Message()
+        msg.add_int(request_number)
+        msg.add_int(len(files))
+        for attr in files:
+            msg.add_string(attr.filename)
+            msg.add_string(attr)
+            attr._pack(msg)
+        self._send_packet(CMD_NAME, msg)
+
+    def _open_folder(self, request_number, path):
+        resp = self.server.list_folder(path)
+        if isinstance(resp, paramiko.SFTPHandle):
+            self._send_handle_response(request_number, resp, True)
+        else:
+            # must be an error code
+            self._send_status(request_number, resp)
+
+
+class ServerTransport(paramiko.Transport):
+    """
+    Transport for the client connections.
+
+    The transport thread wakes up every `_active_check_timeout` seconds to
+    check if it was closed and send the keepalives; paramiko's default (0.1)
+    is too frequent for many idle connections in the same process.
+    """
+    _active_check_timeout = 1.0
+
+    def grow_window(self, chan, size):
+        """
+        Grow the receive window of a channel to size bytes.
+
+        The extra credit is granted to the client with a window adjust
+        message; the window never shrinks.
+        """
+        with chan.lock:
+            if chan.closed or chan.eof_received or not chan.active:
+                return False
+            delta = size - chan.in_window_size
+            if delta <= 0:
+                return False
+            chan.in_window_size = size
+            chan.in_window_threshold = size // 10
+        m = paramiko.Message()
+        m.add_byte(paramiko.common.cMSG_CHANNEL_WINDOW_ADJUST)
+        m.add_int(chan.remote_chanid)
+        m.add_int(delta)
+        self._send_user_message(m)
+        return True
+
+
+class WindowTuner(threading.Thread):
+    """
+    Adaptive receive window for the channels of a transport.
+
+    Every `interval` seconds the rate the data of each channel is consumed
+    is measured, and if the client is sending the window is grown up to
+    `max_window_size` to twice the bandwidth-delay product, using the
+    smallest round trip time measured with a keepalive request (the window
+    limits the data in flight, so a window limited channel doubles its
+    window until the bandwidth is the limit).
+
+    Only the uploads are affected; the downloads depend on the window of
+    the client.
+    """
+
+    interval = 1.0
+
+    def __init__(self, transport, max_window_size, log):
+        super(WindowTuner, self).__init__()
+        self.daemon = True
+        self.transport = transport
+        self.max_window_size = max_window_size
+        self.log = log
+        self.rtt = None
+        # chanid: (channel, bytes consumed at the last check)
+        self.channels = {}
+
+    @staticmethod
+    def _count(chan):
+        """Count the bytes consumed from chan."""
+        check_add_window = chan._check_add_window
+        def wrapper(n):
+            chan.received_bytes += n
+            return check_add_window(n)
+        chan.received_bytes = 0
+        chan._check_add_window = wrapper
+
+    def measure_rtt(self):
+        start = time()
+        # clients reply to unknown requests with a failure, that's enough
+        self.transport.global_request("keepalive@openssh.com", wait=True)
+        if not self.transport.is_active():
+            return
+        rtt = time() - start
+        if self.rtt is None or rtt < self.rtt:
+            self.rtt = rtt
+
+    def run(self):
+        last = time()
+        while self.transport.is_active():
+            sleep(self.interval)
+            now = time()
+            elapsed, last = now - last, now
+            rates = []
+            channels = {}
+            for chan in self.transport._channels.values():
+                if not hasattr(chan, "received_bytes"):
+                    self._count(chan)
+                previous = self.channels.get(chan.chanid, (chan, 0))[1]
+                channels[chan.chanid] = (chan, chan.received_bytes)
+                if chan.received_bytes > previous:
+                    rates.append((chan, (chan.received_bytes - previous) / elapsed))
+            self.channels = channels
+            if not rates:
+                continue
+            self.measure_rtt()
+            if self.rtt is None:
+                continue
+            for chan, rate in rates:
+                size = min(self.max_window_size, int(2 * rate * self.rtt), 2 * chan.in_window_size)
+                if self.transport.grow_window(chan, size):
+                    self.log.debug("channel %s: window grown to %d bytes (%d bytes/s, rtt %.3fs)"
+                                   % (chan.chanid, size, rate, self.rtt))
+
+
 class ObjectStorageSFTPRequestHandler(StreamRequestHandler):
     """
     SocketServer RequestHandler subclass for ObjectStorageSFTPServer.
@@ -220,7 +629,14 @@ class ObjectStorageSFTPRequestHandler(StreamRequestHandler):
     thread.  Note that paramiko.Transport uses a separate thread by default,
     so there is no need to use ThreadingMixin.
 
-    A TERM signal may be processed with a delay up to 10 seconds.
+    In a forked process per connection, the handler runs in the main thread
+    and polls the transport so a TERM signal is processed with a delay up to
+    10 seconds. In the pre-forked workers (`threaded`) the handler runs in
+    its own thread and just waits for the transport to finish.
+
+    The receive window of the channels starts at `window_size` bytes and,
+    if `max_window_size` is set, it's adapted to the measured bandwidth and
+    round trip time (see WindowTuner).
     """
 
     timeout = 60
@@ -230,14 +646,23 @@ class ObjectStorageSFTPRequestHandler(StreamRequestHandler):
     keepalive = 0
     secopts = {}
     server_ident = None
+    threaded = False
+    window_size = paramiko.common.DEFAULT_WINDOW_SIZE
+    max_packet_size = paramiko.common.DEFAULT_MAX_PACKET_SIZE
+    max_window_size = 0
 
     def handle(self):
         Random.atfork()
+        metrics.atfork()
+        if not self.threaded:
+            # the HUP signal hands the server over to a new process, the connection goes on
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
         paramiko.util.get_logger("paramiko.transport").setLevel(logging.CRITICAL)
         self.log = paramiko.util.get_logger("paramiko")
         self.log.debug("%s: start transport" % self.__class__.__name__)
-        self.server.client_address = self.client_address
-        t = paramiko.Transport(self.request)
+        interface = ObjectStorageServerInterface(self.server, self.client_address)
+        t = ServerTransport(self.request, default_window_size=self.window_size,
+                            default_max_packet_size=self.max_packet_size)
         if self.secopts:
             secopt = t.get_security_options()
             for op, val in self.secopts.items():
@@ -251,7 +676,7 @@ class ObjectStorageSFTPRequestHandler(StreamRequestHandler):
         if self.keepalive:
             self.log.debug("%s: setting keepalive to %d" % (self.__class__.__name__, self.keepalive))
             t.set_keepalive(self.keepalive)
-        t.set_subsystem_handler("sftp", paramiko.SFTPServer, SFTPServerInterface, self.server.fs)
+        t.set_subsystem_handler("sftp", SFTPServer, SFTPServerInterface, interface.fs, interface.shaper)
 
         if self.server_ident:
             # expected format SSH-0.0-string; eg. SSH-2.0-paramiko_1.18
@@ -262,62 +687,233 @@ class ObjectStorageSFTPRequestHandler(StreamRequestHandler):
         # asynchronous negotiation with optional time limit; paramiko has a banner timeout already (15 secs)
         start = time()
         event = threading.Event()
+        metrics.inc("sftpcloudfs_sessions_total")
+        metrics.inc("sftpcloudfs_sessions_active")
         try:
-            t.start_server(server=self.server, event=event)
-            while True:
-                if event.wait(0.1):
-                    if not t.is_active():
-                        ex = t.get_exception() or "Negotiation failed."
-                        self.log.warning("%r, disconnecting: %s" % (self.client_address, ex))
-                        return
-                    self.log.debug("negotiation was OK")
-                    break
-                if self.negotiation_timeout > 0 and time()-start > self.negotiation_timeout:
-                    self.log.warning("%r, disconnecting: Negotiation timed out." % (self.client_address,))
-                    return
+            t.start_server(server=interface, event=event)
+            if self.threaded:
+                # the event is set on failure too
+                event.wait(self.negotiation_timeout if self.negotiation_timeout > 0 else None)
+            else:
+                while not event.wait(0.1):
+                    if self.negotiation_timeout > 0 and time()-start > self.negotiation_timeout:
+                        break
+            if not event.is_set():
+                self.log.warning("%r, disconnecting: Negotiation timed out." % (self.client_address,))
+                return
+            if not t.is_active():
+                ex = t.get_exception() or "Negotiation failed."
+                self.log.warning("%r, disconnecting: %s" % (self.client_address, ex))
+                return
+            self.log.debug("negotiation was OK")
 
             chan = t.accept(self.auth_timeout)
             if chan is None:
                 self.log.warning("%r, disconnecting: auth failed, channel is None." % (self.client_address,))
                 return
 
-            while t.isAlive():
-                t.join(timeout=10)
+            if self.max_window_size > self.window_size:
+                WindowTuner(t, self.max_window_size, self.log).start()
+
+            if self.threaded:
+                t.join()
+            else:
+                while t.isAlive():
+                    t.join(timeout=10)
         finally:
             self.log.info("%r, cleaning up connection: bye." % (self.client_address,))
-            if self.server.fs.conn:
-                self.server.fs.conn.close()
+            if interface.fs.conn:
+                interface.fs.conn.close()
+            interface.release()
             t.close()
+            metrics.inc("sftpcloudfs_sessions_active", -1)
+            metrics.flush()
         return
 
-class ObjectStorageSFTPServer(ForkingTCPServer, paramiko.ServerInterface):
+class ObjectStorageSFTPServer(PreforkingMixIn, ForkingTCPServer):
     """
     Expose a ObjectStorageFS object over SFTP.
+
+    By default each connection is served by a forked process; with
+    `prefork_workers` the connections are served by pre-forked worker
+    processes instead, each one handling up to `prefork_connections`
+    connections in threads (see PreforkingMixIn).
+
+    The listening sockets can be taken over from a previous server process
+    with `listen_socket` and `metrics_socket`.
     """
     allow_reuse_address = True
 
     def __init__(self, address, host_key=None, authurl=None, max_children=20, keystone=None,
             no_scp=False, split_size=0, hide_part_dir=False, auth_timeout=None,
             negotiation_timeout=0, keepalive=0, insecure=False, secopts=None,
-            server_ident=None, storage_policy=None):
+            server_ident=None, storage_policy=None, parallel_download_workers=0,
+            parallel_download_size=0, write_buffer_size=None, write_buffer_total=None,
+            parallel_upload_workers=0, storage_pool_size=0, storage_pool_idle_timeout=30,
+            prefork_workers=0, prefork_connections=50, prefork_max_requests=0,
+            token_cache=None, token_cache_dir=None, token_cache_ttl=3600, token_cache_salt=None,
+            metrics_address=None, trace_sample=0, trace_ops=None, metadata_cache_size=None,
+            metadata_cache_ttl=None, rename_workers=None, remove_batch_window=None,
+            scp_prefetch_workers=None, scp_prefetch_memory=None, scp_receive_buffer=None,
+            ssh_window_size=None, ssh_max_packet_size=None, ssh_max_window_size=None,
+            scp_chunk_size=None, scp_timeout=None, sftp_read_chunk_size=None,
+            authorized_keys=None, authorized_keys_path=None, max_sessions=0, max_sessions_per_user=0,
+            max_sessions_per_ip=0, admission_timeout=10.0, admission_socket=None,
+            session_upload_limit=0, session_download_limit=0, user_upload_limit=0,
+            user_download_limit=0, upload_limit=0, download_limit=0, listen_socket=None,
+            metrics_socket=None):
         self.log = paramiko.util.get_logger("paramiko")
         self.log.debug("%s: start server" % self.__class__.__name__)
-        self.fs = ObjectStorageFS(None, None, authurl=authurl, keystone=keystone, hide_part_dir=hide_part_dir,
-                                  insecure=insecure, storage_policy=storage_policy) # unauthorized
+        self.fs_kwargs = dict(authurl=authurl, keystone=keystone, hide_part_dir=hide_part_dir,
+                              insecure=insecure, storage_policy=storage_policy)
         self.host_key = host_key
         self.max_children = max_children
+        self.workers = prefork_workers
+        self.max_connections = prefork_connections
+        self.max_requests = prefork_max_requests
         self.no_scp = no_scp
+        if authorized_keys == "file":
+            self.authorized_keys = FileAuthorizedKeys(authorized_keys_path)
+        elif authorized_keys == "sqlite":
+            self.authorized_keys = SQLiteAuthorizedKeys(authorized_keys_path)
+        else:
+            self.authorized_keys = None
+        if max_sessions or max_sessions_per_user or max_sessions_per_ip:
+            self.admission_server = AdmissionServer(admission_socket, max_sessions_per_user,
+                                                    max_sessions_per_ip, max_sessions, admission_timeout)
+            self.admission = Admission(admission_socket, admission_timeout)
+        else:
+            self.admission_server = self.admission = None
+        # created before forking, the limits per user and in total are shared by the processes
+        self.shaping = Shaping(session=(session_upload_limit, session_download_limit),
+                               user=(user_upload_limit, user_download_limit),
+                               total=(upload_limit, download_limit)) or None
         ObjectStorageSFTPRequestHandler.auth_timeout = auth_timeout
         ObjectStorageSFTPRequestHandler.negotiation_timeout = negotiation_timeout
         ObjectStorageSFTPRequestHandler.keepalive = keepalive
         ObjectStorageSFTPRequestHandler.secopts = secopts
         ObjectStorageSFTPRequestHandler.server_ident = server_ident
-        ForkingTCPServer.__init__(self, address, ObjectStorageSFTPRequestHandler)
+        ObjectStorageSFTPRequestHandler.threaded = bool(prefork_workers)
+        if ssh_window_size:
+            ObjectStorageSFTPRequestHandler.window_size = ssh_window_size
+        if ssh_max_packet_size:
+            ObjectStorageSFTPRequestHandler.max_packet_size = ssh_max_packet_size
+        if ssh_max_window_size is not None:
+            ObjectStorageSFTPRequestHandler.max_window_size = ssh_max_window_size
+        ForkingTCPServer.__init__(self, address, ObjectStorageSFTPRequestHandler,
+                                  bind_and_activate=listen_socket is None)
+        if listen_socket:
+            # taken over from the previous server process
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
         ObjectStorageFD.split_size = split_size
         ObjectStorageFD.storage_policy = storage_policy
+        ParallelReadFD.workers = parallel_download_workers
+        if parallel_download_size:
+            ParallelReadFD.range_size = parallel_download_size
+        ParallelWriteFD.workers = parallel_upload_workers
+        if write_buffer_size is not None:
+            SFTPHandle.write_buffer_size = write_buffer_size
+        if write_buffer_total is not None:
+            SFTPHandle.write_buffer_total = write_buffer_total
+        if storage_pool_size:
+            PooledConnection.pool = ConnectionPool(storage_pool_size, storage_pool_idle_timeout)
+        self.token_broker = None
+        if token_cache == "memcache":
+            if ObjectStorageFS.memcache_hosts:
+                PooledConnection.token_cache = MemcacheTokenCache(ObjectStorageFS.memcache_hosts,
+                                                                  token_cache_ttl, token_cache_salt)
+        elif token_cache == "file":
+            PooledConnection.token_cache = FileTokenCache(token_cache_dir, token_cache_ttl, token_cache_salt)
+        elif token_cache == "broker":
+            path = os.path.join(token_cache_dir, "broker.sock")
+            self.token_broker = TokenBroker(path, token_cache_ttl)
+            PooledConnection.token_cache = BrokerTokenCache(path, token_cache_ttl, token_cache_salt)
+        self.metrics = MetricsServer(metrics_address, metrics_socket) if metrics_address else None
+        if metadata_cache_size is not None:
+            ObjectStorageFS.metadata_cache_size = metadata_cache_size
+        if metadata_cache_ttl is not None:
+            ObjectStorageFS.metadata_cache_ttl = metadata_cache_ttl
+        if rename_workers:
+            ObjectStorageFS.rename_workers = rename_workers
+        if remove_batch_window is not None:
+            SFTPServer.remove_batch_window = remove_batch_window
+        if scp_prefetch_workers is not None:
+            SCPHandler.prefetch_workers = scp_prefetch_workers
+        if scp_prefetch_memory is not None:
+            SCPHandler.prefetch_memory = scp_prefetch_memory
+        if scp_receive_buffer is not None:
+            SCPHandler.receive_buffer = scp_receive_buffer
+        if scp_chunk_size:
+            SCPHandler.CHUNK_SIZE = scp_chunk_size
+        if scp_timeout:
+            SCPHandler.TIMEOUT = scp_timeout
+        if sftp_read_chunk_size:
+            SFTPHandle.READ_CHUNK = sftp_read_chunk_size
+        SFTPTrace.sample = trace_sample
+        SFTPTrace.ops = frozenset(trace_ops or ())
+
+    def serve_forever(self, *args, **kwargs):
+        if self.metrics:
+            self.metrics.start()
+        if self.token_broker:
+            self.token_broker.start()
+        if self.admission_server:
+            self.admission_server.start()
+        super(ObjectStorageSFTPServer, self).serve_forever(*args, **kwargs)
+
+    def drain(self, timeout=0):
+        if self.metrics:
+            # the new server process serves the metrics
+            self.metrics.shutdown()
+            self.metrics.server_close()
+        super(ObjectStorageSFTPServer, self).drain(timeout)
+
+    def server_close(self):
+        if self.token_broker:
+            self.token_broker.close()
+        if self.admission_server:
+            self.admission_server.close()
+        super(ObjectStorageSFTPServer, self).server_close()
+
+    def new_fs(self):
+        """Return a new (unauthorized) ObjectStorageFS for a connection."""
+        return ObjectStorageFS(None, None, **self.fs_kwargs)
+
+    def worker_init(self):
+        Random.atfork()
+        metrics.atfork()
+        # time.strptime (used by the listings) is not thread safe on first use
+        import _strptime
+        self.log.debug("worker %s started" % os.getpid())
+
+
+class ObjectStorageServerInterface(paramiko.ServerInterface):
+    """
+    ServerInterface for a client connection, with its own ObjectStorageFS.
+    """
+
+    def __init__(self, server, client_address):
+        self.log = paramiko.util.get_logger("paramiko")
+        self.client_address = client_address
+        self.no_scp = server.no_scp
+        self.authorized_keys = server.authorized_keys
+        # credentials of a public key authentication, until they are used
+        self.key_login = None
+        self.admission = server.admission
+        # socket held while the session is admitted
+        self.admission_ticket = None
+        self.username = None
+        self.shaper = server.shaping.new_session() if server.shaping else None
+        self.fs = server.new_fs()
 
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
+            if self.key_login and not self._key_login():
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+            if not self._admit():
+                return paramiko.OPEN_FAILED_RESOURCE_SHORTAGE
             return paramiko.OPEN_SUCCEEDED
         self.log.warning("Channel request denied from %s, kind=%s" \
                          % (self.client_address, kind))
@@ -344,7 +940,7 @@ class ObjectStorageSFTPServer(ForkingTCPServer, paramiko.ServerInterface):
                     return False
                 self.log.info('invoking %r from=%s' % (command, self.client_address))
                 # handle the command execution
-                SCPHandler(command[1:], channel, self.fs, self.log).start()
+                SCPHandler(command[1:], channel, self.fs, self.log, self.shaper).start()
                 return True
         except:
             self.log.exception("command %r failed from=%s" % (command, self.client_address))
@@ -356,31 +952,105 @@ class ObjectStorageSFTPServer(ForkingTCPServer, paramiko.ServerInterface):
         """Check whether the user can proceed without authentication."""
         return paramiko.AUTH_FAILED
 
-    def check_auth_publickey(self, username, key):
-        """Check whether the given public key is valid for authentication."""
-        return paramiko.AUTH_FAILED
-
-    def check_auth_password(self, username, password):
-        """Check whether the given password is valid for authentication."""
-        self.log.info("Auth request (type=password), username=%s, from=%s" \
-                      % (username, self.client_address))
+    def _login(self, username, login, *args):
+        """Open the connection to the Object Storage calling login(*args), return True on success."""
+        start = time()
         try:
-            if not password:
-                raise EnvironmentError("no password provided")
-            self.fs.authenticate(username, password)
+            login(*args)
         except EnvironmentError, e:
+            metrics.observe("sftpcloudfs_auth_seconds", time()-start, result="failure")
             self.log.warning("%s: Failed to authenticate: %s" % (self.client_address, e))
             self.log.error("Authentication failure for %s from %s port %s" % (username,
                            self.client_address[0], self.client_address[1]))
-            return paramiko.AUTH_FAILED
+            return False
+        metrics.observe("sftpcloudfs_auth_seconds", time()-start, result="success")
         self.fs.conn.real_ip = self.client_address[0]
+        self.username = username
+        if self.shaper:
+            self.shaper.user = username
         self.log.info("%s authenticated from %s" % (username, self.client_address))
+        return True
+
+    def _admit(self):
+        """
+        Wait until the session is admitted by the session limits, return True on success.
+
+        The session is admitted when its first channel is requested, once
+        the user is authenticated.
+        """
+        if not self.admission or self.admission_ticket:
+            return True
+        start = time()
+        try:
+            self.admission_ticket, reason = self.admission.acquire(self.username, self.client_address[0])
+        except (EnvironmentError, ValueError), ex:
+            # don't refuse the sessions because of a failure of the admission control
+            self.log.error("%s: admission failed, session allowed: %s" % (self.client_address, ex))
+            return True
+        metrics.observe("sftpcloudfs_admission_wait_seconds", time()-start)
+        if not self.admission_ticket:
+            metrics.inc("sftpcloudfs_admission_rejected_total")
+            self.log.warning("%s: session of %s not admitted: %s" % (self.client_address, self.username, reason))
+            return False
+        return True
+
+    def release(self):
+        """Release the session slot, if any."""
+        if self.admission_ticket:
+            self.admission_ticket.close()
+            self.admission_ticket = None
+
+    def check_auth_password(self, username, password):
+        """Check whether the given password is valid for authentication."""
+        self.log.info("Auth request (type=password), username=%s, from=%s" \
+                      % (username, self.client_address))
+        # an empty password is rejected by authenticate
+        if not self._login(username, self.fs.authenticate, username, password):
+            return paramiko.AUTH_FAILED
+        self.key_login = None
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        """
+        Check whether the given public key is allowed for authentication.
+
+        This is called before the signature is verified, so the connection
+        to the Object Storage is opened with the credentials of the key when
+        the first channel is requested.
+        """
+        self.log.info("Auth request (type=publickey), username=%s, key=%s, from=%s" \
+                      % (username, fingerprint(key.asbytes()), self.client_address))
+        credentials = None
+        if self.authorized_keys:
+            try:
+                credentials = self.authorized_keys.get(username, key)
+            except Exception:
+                self.log.exception("failed to look up the authorized keys")
+        if not credentials:
+            # clients try their keys in turn, this is not an authentication failure yet
+            self.log.info("%s: key not authorized for %s" % (self.client_address, username))
+            return paramiko.AUTH_FAILED
+        self.key_login = (username, credentials)
         return paramiko.AUTH_SUCCESSFUL
 
+    def _key_login(self):
+        """Open the connection to the Object Storage for a public key authentication."""
+        username, credentials = self.key_login
+        if "token" in credentials:
+            login = (self.fs.authenticate_token, username, credentials["url"], credentials["token"])
+        else:
+            login = (self.fs.authenticate, username, credentials["password"])
+        if not self._login(username, *login):
+            return False
+        self.key_login = None
+        return True
+
     def get_allowed_auths(self,username):
         """Return string containing a comma separated list of allowed auth modes.
 
         The available modes are  "node", "password" and "publickey".
         """
+        if self.authorized_keys:
+            return "publickey,password"
         return "password"
 
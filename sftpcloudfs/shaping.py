@@ -0,0 +1,201 @@
+#!/usr/bin/python
+"""
+Bandwidth shaping with token buckets.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import ctypes
+import multiprocessing
+import struct
+import threading
+from hashlib import md5
+from time import time, sleep
+
+import paramiko
+
+from ftpcloudfs.utils import smart_str
+from sftpcloudfs.metrics import metrics
+
+__all__ = ['TokenBucket', 'SharedTokenBuckets', 'Shaping', 'SessionShaper']
+
+# seconds of traffic at full rate allowed in a burst
+BURST = 1.0
+# the burst is never smaller than this, so a single read or write fits
+MIN_BURST = 256*1024
+
+
+def _take(tokens, stamp, rate, n, now):
+    """
+    Take n tokens from a bucket with tokens at stamp, filled at rate.
+
+    The bucket can go into debt; return (tokens, seconds to wait until the
+    debt is paid).
+    """
+    burst = max(rate * BURST, MIN_BURST)
+    tokens = min(burst, tokens + (now - stamp) * rate) - n
+    return tokens, (-tokens / rate if tokens < 0 else 0.0)
+
+
+class TokenBucket(object):
+    """Token bucket of a process, with `rate` tokens (bytes) per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = max(rate * BURST, MIN_BURST)
+        self.stamp = time()
+
+    def take(self, n):
+        """Take n tokens, return the seconds to wait before using them."""
+        with self.lock:
+            now = time()
+            self.tokens, wait = _take(self.tokens, self.stamp, self.rate, n, now)
+            self.stamp = now
+        return wait
+
+
+class SharedTokenBuckets(object):
+    """
+    Token buckets in shared memory, by key, with `rate` tokens per second.
+
+    The table is created by the server process so the forked processes
+    share it. A key gets a slot on first use, found by a hash of the key;
+    slots idle for a while (so their bucket is full) are reused. If there
+    are no free slots the key is not limited.
+    """
+
+    # seconds a slot is kept after it was last used with a full bucket
+    idle = 60.0
+
+    def __init__(self, rate, slots=1):
+        self.rate = rate
+        self.slots = slots
+        self.lock = multiprocessing.Lock()
+        self.keys = multiprocessing.RawArray(ctypes.c_uint64, slots)
+        self.tokens = multiprocessing.RawArray(ctypes.c_double, slots)
+        self.stamps = multiprocessing.RawArray(ctypes.c_double, slots)
+        self.full = False
+        # a reused slot must have been idle long enough to fill its bucket
+        self.reuse = self.idle + max(rate * BURST, MIN_BURST) / rate
+
+    @staticmethod
+    def _hash(key):
+        # 0 is a free slot
+        return struct.unpack("<Q", md5(smart_str(key)).digest()[:8])[0] or 1
+
+    def _slot(self, key, now):
+        """Return the slot for key, or None if there are no free slots. Called with the lock."""
+        start = key % self.slots
+        free = None
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            if self.keys[slot] == key:
+                return slot
+            if free is None and (not self.keys[slot] or now - self.stamps[slot] > self.reuse):
+                free = slot
+            if not self.keys[slot]:
+                break
+        if free is not None:
+            self.keys[free] = key
+            self.tokens[free] = max(self.rate * BURST, MIN_BURST)
+            self.stamps[free] = now
+        return free
+
+    def take(self, key, n):
+        """Take n tokens from the bucket of key, return the seconds to wait before using them."""
+        key = self._hash(key)
+        with self.lock:
+            now = time()
+            slot = self._slot(key, now)
+            if slot is None:
+                if not self.full:
+                    self.full = True
+                    paramiko.util.get_logger("paramiko").warning("bandwidth shaping: no free slots")
+                return 0.0
+            self.tokens[slot], wait = _take(self.tokens[slot], self.stamps[slot], self.rate, n, now)
+            self.stamps[slot] = now
+        return wait
+
+
+class Shaping(object):
+    """
+    Bandwidth limits of the server, in bytes per second (0 is no limit),
+    per session, per user (shared by the sessions of the user) and in
+    total, for uploads ("in") and downloads ("out").
+    """
+
+    # users with their own buckets at the same time
+    user_slots = 4096
+
+    def __init__(self, session=(0, 0), user=(0, 0), total=(0, 0)):
+        self.session = dict(zip(("in", "out"), session))
+        self.user = dict((direction, SharedTokenBuckets(rate, self.user_slots))
+                         for direction, rate in zip(("in", "out"), user) if rate)
+        self.total = dict((direction, SharedTokenBuckets(rate))
+                          for direction, rate in zip(("in", "out"), total) if rate)
+
+    def __nonzero__(self):
+        return bool(any(self.session.values()) or self.user or self.total)
+
+    def new_session(self):
+        """Return the SessionShaper for a new session."""
+        return SessionShaper(self)
+
+
+class SessionShaper(object):
+    """
+    Bandwidth shaping of a session.
+
+    The session waits in upload() and download() until the transferred
+    data is allowed by all the limits; the user limits apply once the
+    user is set.
+    """
+
+    def __init__(self, shaping):
+        self.shaping = shaping
+        self.buckets = dict((direction, TokenBucket(rate))
+                            for direction, rate in shaping.session.items() if rate)
+        self.user = None
+
+    def _shape(self, direction, size, protocol):
+        wait = 0.0
+        bucket = self.buckets.get(direction)
+        if bucket:
+            wait = bucket.take(size)
+        buckets = self.shaping.user.get(direction)
+        if buckets and self.user:
+            wait = max(wait, buckets.take(self.user, size))
+        buckets = self.shaping.total.get(direction)
+        if buckets:
+            wait = max(wait, buckets.take(0, size))
+        if wait:
+            metrics.observe("sftpcloudfs_shaping_wait_seconds", wait, protocol=protocol, direction=direction)
+            sleep(wait)
+
+    def upload(self, size, protocol):
+        """Wait until size bytes received from the client are allowed."""
+        self._shape("in", size, protocol)
+
+    def download(self, size, protocol):
+        """Wait until size bytes sent to the client are allowed."""
+        self._shape("out", size, protocol)
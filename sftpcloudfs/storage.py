@@ -0,0 +1,1111 @@
+#!/usr/bin/python
+"""
+Object Storage file system extensions used by the SFTP server.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import json
+import logging
+import posixpath
+import threading
+import time
+from Queue import Queue
+from collections import deque, OrderedDict
+from errno import EPERM, EACCES, EINVAL, EIO, ENOENT, ENOTDIR, ENOTEMPTY
+from urllib import unquote
+
+import paramiko
+from swiftclient.client import quote, ClientException
+from ftpcloudfs.fs import ObjectStorageFS as BaseObjectStorageFS, ObjectStorageFD, \
+    IOSError, translate_objectstorage_error, close_when_done, parse_fspath
+from ftpcloudfs.utils import smart_str, smart_unicode
+from sftpcloudfs.pool import PooledConnection
+
+__all__ = ['ObjectStorageFS', 'MetadataCache', 'StreamingReadFD', 'StreamingWriteFD', 'ParallelReadFD',
+           'ParallelWriteFD']
+
+
+def object_size(headers):
+    """Return the size of an object from the headers of a GET response."""
+    try:
+        if 'content-range' in headers:
+            # bytes start-end/size
+            return int(headers['content-range'].rsplit('/', 1)[1])
+        return int(headers['content-length'])
+    except (KeyError, ValueError):
+        raise IOSError(EPERM, "Invalid file size")
+
+
+class Job(object):
+    """A call to be run by a WorkerPool thread, func(conn, *args)."""
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.data = None
+        self.error = None
+        self.cancelled = False
+        self.event = threading.Event()
+
+    def run(self, conn):
+        if not self.cancelled:
+            try:
+                self.data = self.func(conn, *self.args)
+            except Exception, ex:
+                self.error = ex
+        self.event.set()
+
+    def result(self):
+        """Wait for the job to be done and return its result."""
+        self.event.wait()
+        if self.error:
+            raise self.error
+        return self.data
+
+
+class WorkerPool(object):
+    """
+    Pool of threads running jobs, each thread with its own connection.
+
+    The connections reuse the storage URL and token of the connection
+    provided, so the threads don't need to authenticate. If queue_size is
+    provided, submit blocks while there are that many jobs queued.
+    """
+
+    def __init__(self, conn, size, queue_size=0):
+        self.conn = conn
+        self.size = size
+        self.jobs = Queue(queue_size)
+        self.threads = []
+
+    def submit(self, func, *args):
+        """Queue a call to func(conn, *args) and return its Job."""
+        if len(self.threads) < self.size:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        job = Job(func, *args)
+        self.jobs.put(job)
+        return job
+
+    def close(self):
+        """Stop the threads once the queued jobs are done."""
+        for _ in self.threads:
+            self.jobs.put(None)
+        self.threads = []
+
+    def _worker(self):
+        conn = PooledConnection(None, preauthurl=self.conn.url, preauthtoken=self.conn.token,
+                                insecure=self.conn.insecure)
+        conn.real_ip = self.conn.real_ip
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                job.run(conn)
+        finally:
+            conn.close()
+
+
+class StreamingReadFD(ObjectStorageFD):
+    """
+    File alike object reading from the Object Storage with a single GET.
+
+    The size of the object is taken from the GET response, so there's no
+    need of a HEAD request before reading. Seeking before the first read is
+    allowed and the offset is checked when the data is requested.
+    """
+
+    @translate_objectstorage_error
+    def read(self, size=65536):
+        """
+        Read data from the object.
+
+        NB: It uses the size passed into the first call for all subsequent calls.
+        """
+        if self.size is not None and self.total_size >= self.size:
+            return ""
+
+        if self.obj is None:
+            headers = { }
+            if self.total_size > 0:
+                headers["Range"] = "bytes=%d-" % self.total_size
+            try:
+                resp_headers, self.obj = self.conn.get_object(self.container, self.name,
+                                                              resp_chunk_size=size, headers=headers)
+            except ClientException, ex:
+                # seek past the end of the object
+                if ex.http_status == 416:
+                    return ""
+                raise
+            self.size = object_size(resp_headers)
+
+        logging.debug("read size=%r, total_size=%r" % (size, self.total_size))
+
+        try:
+            buff = self.obj.next()
+            self.total_size += len(buff)
+        except StopIteration:
+            return ""
+        else:
+            return buff
+
+    def seek(self, offset, whence=None):
+        """Seek in the object, the offset is checked on read if the size is unknown."""
+        if self.size is None and not whence:
+            logging.debug("seek offset=%s (size unknown)" % offset)
+            if offset < 0:
+                raise IOSError(EPERM, "Invalid file offset")
+            self.obj = None
+            self.total_size = offset
+            return
+        super(StreamingReadFD, self).seek(offset, whence)
+
+
+class StreamingWriteFD(ObjectStorageFD):
+    """
+    File alike object writing to the Object Storage with a chunked PUT.
+
+    The upload can be aborted, leaving the object as it was (unless it's a
+    large file and its first segment was already stored).
+    """
+
+    def abort(self):
+        """Close the object without storing the data written."""
+        logging.debug("abort write %r" % self.name)
+        if self.obj is not None and self.obj.raw_conn is not None:
+            # without the last chunk the request is not complete
+            self.obj.raw_conn.close()
+            self.obj.conn.request_session.close()
+        if self.pending_copy_task:
+            self.pending_copy_task.join()
+        self.obj = None
+        self.closed = True
+        self.conn.close()
+
+
+class ParallelReadFD(ObjectStorageFD):
+    """
+    File alike object reading from the Object Storage using parallel ranged GETs.
+
+    The object is split in range_size ranges that are fetched by up to
+    `workers` threads, each one using its own connection, and read returns
+    the data in order. At most `workers` ranges are requested ahead of the
+    current read position.
+
+    The first range is requested directly and its response provides the
+    size of the object, so objects smaller than range_size are read with a
+    single request.
+    """
+
+    # number of concurrent ranged GET requests (0 disables parallel reads)
+    workers = 0
+    # size of each range in bytes
+    range_size = 8*10**6
+
+    def __init__(self, connection, container, obj, mode):
+        super(ParallelReadFD, self).__init__(connection, container, obj, mode)
+        if 'r' not in self.mode:
+            raise IOSError(EPERM, "Parallel reads require read mode")
+        self._pool = WorkerPool(connection, self.workers)
+        self._ranges = deque()
+        self._next_range = 0
+        self._buffer = ""
+        self._buffer_pos = 0
+
+    def _get_range(self, conn, start, end):
+        headers = { 'Range': 'bytes=%d-%d' % (start, end-1) }
+        logging.debug("parallel read %r range %r" % (self.name, headers))
+        _, data = conn.get_object(self.container, self.name, headers=headers)
+        return data
+
+    def _get_first_range(self):
+        """Get the range at the current position and the size of the object."""
+        start = self._next_range
+        headers = { 'Range': 'bytes=%d-%d' % (start, start+self.range_size-1) }
+        logging.debug("parallel read %r first range %r" % (self.name, headers))
+        try:
+            resp_headers, data = self.conn.get_object(self.container, self.name, headers=headers)
+        except ClientException, ex:
+            # seek past the end of the object
+            if ex.http_status == 416:
+                self.size = start
+                return ""
+            raise
+        self.size = object_size(resp_headers)
+        if 'content-range' not in resp_headers:
+            # the range was ignored and we got the whole object
+            data = data[start:]
+        self._next_range = start + len(data)
+        return data
+
+    def _schedule(self):
+        """Request ranges until there are as many in flight as workers."""
+        while len(self._ranges) < self.workers and self._next_range < self.size:
+            end = min(self._next_range + self.range_size, self.size)
+            self._ranges.append(self._pool.submit(self._get_range, self._next_range, end))
+            self._next_range = end
+
+    def _cancel(self):
+        """Cancel the ranges in flight and discard the buffered data."""
+        for job in self._ranges:
+            job.cancelled = True
+        self._ranges.clear()
+        self._buffer = ""
+        self._buffer_pos = 0
+
+    @translate_objectstorage_error
+    def read(self, size=65536):
+        """Read up to size bytes from the object."""
+        if self._buffer_pos >= len(self._buffer):
+            if self.size is None:
+                self._buffer = self._get_first_range()
+            else:
+                self._schedule()
+                if not self._ranges:
+                    return ""
+                self._buffer = self._ranges.popleft().result()
+            self._buffer_pos = 0
+            self._schedule()
+
+        data = self._buffer[self._buffer_pos:self._buffer_pos+size]
+        self._buffer_pos += len(data)
+        self.total_size += len(data)
+        return data
+
+    def seek(self, offset, whence=None):
+        """Seek in the object, discarding any range requested ahead."""
+        logging.debug("parallel seek offset=%s, whence=%s" % (offset, whence))
+        if self.size is None and whence:
+            # the size is unknown until the first range is read
+            self.size = object_size(self.conn.head_object(self.container, self.name))
+
+        if not whence:
+            offs = offset
+        elif whence == 1:
+            offs = self.total_size + offset
+        elif whence == 2:
+            offs = self.size - offset
+        else:
+            raise IOSError(EPERM, "Invalid file offset")
+
+        if offs < 0 or (self.size is not None and offs > self.size):
+            raise IOSError(EPERM, "Invalid file offset")
+
+        self._cancel()
+        self._next_range = self.total_size = offs
+
+    def close(self):
+        """Close the object and stop the workers."""
+        self._cancel()
+        self._pool.close()
+        super(ParallelReadFD, self).close()
+
+
+class ParallelWriteFD(ObjectStorageFD):
+    """
+    File alike object writing large files to the Object Storage in parallel.
+
+    The data is split in split_size segments kept in memory, and full
+    segments are uploaded by up to `workers` threads while the following
+    segment is received. Once all the segments are stored, the manifest is
+    created. Files smaller than a segment are stored as a single object.
+
+    Memory usage is around (workers + 1) * split_size.
+    """
+
+    # number of concurrent segment uploads (0 disables parallel uploads)
+    workers = 0
+
+    def __init__(self, connection, container, obj, mode):
+        super(ParallelWriteFD, self).__init__(connection, container, obj, mode)
+        if 'r' in self.mode:
+            raise IOSError(EPERM, "Parallel writes require write mode")
+        # segments are sent in one request, not using chunked transfer
+        self.obj = None
+        self._pool = WorkerPool(connection, self.workers)
+        self._segment = []
+        self._first = None
+        self._uploads = deque()
+
+    def _segment_name(self, part):
+        return "%s/%.6d" % (self.part_base_name, part)
+
+    def _put(self, conn, name, data):
+        logging.debug("parallel write %r (%s bytes)" % (name, len(data)))
+        conn.put_object(self.container, name, contents=data, content_type=self.content_type)
+
+    def _upload(self, part, data):
+        """Upload a segment, waiting for a worker to be free if required."""
+        if len(self._uploads) >= self.workers:
+            self._uploads.popleft().result()
+        self._uploads.append(self._pool.submit(self._put, self._segment_name(part), data))
+
+    def _add_segment(self, data):
+        # the first segment waits to know if the file needs to be split at all
+        if self.part == 0:
+            self._first = data
+        else:
+            if self._first is not None:
+                self._upload(0, self._first)
+                self._first = None
+            self._upload(self.part, data)
+        self.part += 1
+
+    @translate_objectstorage_error
+    def write(self, data):
+        """Write data to the object."""
+        self._segment.append(data)
+        self.part_size += len(data)
+        self.total_size += len(data)
+        while self.part_size >= self.split_size:
+            buff = "".join(self._segment)
+            self._add_segment(buff[:self.split_size])
+            buff = buff[self.split_size:]
+            self._segment = [buff] if buff else []
+            self.part_size = len(buff)
+
+    def abort(self):
+        """Close the object without storing the data written (uploaded segments are kept)."""
+        logging.debug("abort parallel write %r" % self.name)
+        self._segment = []
+        self._first = None
+        for job in self._uploads:
+            job.cancelled = True
+        self._uploads.clear()
+        self._pool.close()
+        self.closed = True
+        self.conn.close()
+
+    @translate_objectstorage_error
+    def close(self):
+        """Close the object and finish the data transfer."""
+        try:
+            data = "".join(self._segment)
+            self._segment = []
+            if self.part == 0 or (self.part == 1 and not data):
+                # not a large file after all
+                self._put(self.conn, self.name, self._first if self.part else data)
+            else:
+                if data:
+                    self._add_segment(data)
+                elif self._first is not None:
+                    self._upload(0, self._first)
+                self._first = None
+                while self._uploads:
+                    self._uploads.popleft().result()
+                headers = { 'x-object-manifest': quote("%s/%s" % (self.container, self.part_base_name)) }
+                logging.debug("creating manifest %r/%r, %r" % (self.container, self.name, headers))
+                self.conn.put_object(self.container, self.name, headers=headers, contents=None,
+                                     content_type=self.content_type)
+        finally:
+            for job in self._uploads:
+                job.cancelled = True
+            self._uploads.clear()
+            self._pool.close()
+            self.closed = True
+            self.conn.close()
+
+
+class MetadataCache(object):
+    """
+    LRU cache of stat results by path.
+
+    Keeps up to `size` entries (0 disables the cache) for `ttl` seconds.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, path):
+        """Return the stat result for path, or None if not cached."""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                return None
+            if time.time() - entry[0] >= self.ttl:
+                return None
+            # most recently used go last
+            self.entries[path] = entry
+            return entry[1]
+
+    def set(self, path, stat):
+        if not self.size:
+            return
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = (time.time(), stat)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path, recursive=False):
+        """Remove path, and everything under it if recursive, from the cache."""
+        with self.lock:
+            self.entries.pop(path, None)
+            if recursive:
+                prefix = path.rstrip("/") + "/"
+                for key in [key for key in self.entries if key.startswith(prefix)]:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ObjectStorageFS(BaseObjectStorageFS):
+    """
+    Object Storage File System emulation with the extensions used by the server.
+
+    The stat results, including the ones of the directory listings, are kept
+    in a metadata cache, so stat calls following a listing don't need to
+    request the listing again. Our changes invalidate the affected entries,
+    changes by other clients are seen once the entries expire.
+    """
+
+    # number of entries requested per listing page when iterating a directory
+    listdir_page_size = 1000
+
+    # max entries (0 disables it) and seconds to keep them in the metadata cache
+    metadata_cache_size = 10000
+    metadata_cache_ttl = 10
+
+    # threads copying and deleting the objects when renaming a directory
+    rename_workers = 8
+    # seconds between the progress messages of a directory rename
+    rename_progress_interval = 10
+
+    def __init__(self, *args, **kwargs):
+        super(ObjectStorageFS, self).__init__(*args, **kwargs)
+        self._metadata_cache = MetadataCache(self.metadata_cache_size, self.metadata_cache_ttl)
+        # max paths per bulk-delete request, 0 if not supported (None until known)
+        self._bulk_delete_limit = None
+
+    def _cache_path(self, path):
+        """Return the metadata cache key for path."""
+        return smart_unicode(self.abspath(path).rstrip("/") or "/", "utf-8")
+
+    def _cache_listing(self, path, entries):
+        """Add the (leafname, stat_result) entries of the directory path to the metadata cache."""
+        path = self._cache_path(path)
+        for name, stat in entries:
+            self._metadata_cache.set(posixpath.join(path, smart_unicode(name, "utf-8")), stat)
+
+    def invalidate(self, path, recursive=False):
+        """Remove path (and its contents if recursive) from the metadata cache."""
+        self._metadata_cache.invalidate(self._cache_path(path), recursive)
+
+    def stat(self, path):
+        """
+        Return os.stat_result object for path, from the metadata cache if possible.
+
+        Raises OSError on error.
+        """
+        key = self._cache_path(path)
+        stat = self._metadata_cache.get(key)
+        if stat is not None:
+            logging.debug("stat %r (cached)" % key)
+            return stat
+        stat = super(ObjectStorageFS, self).stat(path)
+        self._metadata_cache.set(key, stat)
+        # the directory was listed to stat path, keep its entries too
+        listing = self._listdir_cache
+        if key != "/" and listing.cache and listing.path == posixpath.dirname(smart_str(key)):
+            self._cache_listing(listing.path, listing.cache.iteritems())
+        return stat
+
+    lstat = stat
+
+    def listdir_with_stat(self, path):
+        entries = super(ObjectStorageFS, self).listdir_with_stat(path)
+        self._cache_listing(path, entries)
+        return entries
+
+    def mkdir(self, path):
+        self.invalidate(path)
+        try:
+            return super(ObjectStorageFS, self).mkdir(path)
+        finally:
+            self.invalidate(path)
+            self.invalidate(posixpath.dirname(self.abspath(path)))
+
+    def rmdir(self, path):
+        try:
+            return super(ObjectStorageFS, self).rmdir(path)
+        finally:
+            self.invalidate(path, recursive=True)
+            self.invalidate(posixpath.dirname(self.abspath(path)))
+
+    def remove(self, path):
+        try:
+            return super(ObjectStorageFS, self).remove(path)
+        finally:
+            self.invalidate(path)
+            self.invalidate(posixpath.dirname(self.abspath(path)))
+
+    def remove_many(self, paths):
+        """
+        Remove several files, using bulk-delete requests if supported.
+
+        Returns a list with None or the error (an EnvironmentError) for each
+        path. The paths that a listing shows as plain objects are deleted in
+        bulk; anything else (eg. a manifest, that needs its segments removed
+        too) is removed with remove.
+        """
+        try:
+            return self._remove_many(paths)
+        finally:
+            for path in paths:
+                self.invalidate(path)
+                self.invalidate(posixpath.dirname(self.abspath(path)))
+
+    @close_when_done
+    @translate_objectstorage_error
+    def _remove_many(self, paths):
+        errors = [None] * len(paths)
+        limit = self._get_bulk_delete_limit()
+        fallback = []
+        groups = {}
+        for index, path in enumerate(paths):
+            container, name = parse_fspath(self.abspath(path))
+            if not limit or not name:
+                fallback.append(index)
+                continue
+            groups.setdefault((container, posixpath.dirname(name)), []).append((index, name))
+
+        bulk = []
+        for (container, dirname), items in groups.iteritems():
+            objects = self._list_objects(container, dirname, [name for _, name in items])
+            for index, name in items:
+                obj = objects.get(smart_unicode(name, "utf-8"))
+                if obj and obj.get('bytes') and obj.get('content_type') != 'application/directory':
+                    bulk.append((index, "/%s/%s" % (smart_str(container), smart_str(name))))
+                else:
+                    # not found, directories and possible manifests
+                    fallback.append(index)
+
+        logging.debug("remove_many: %s bulk, %s one by one" % (len(bulk), len(fallback)))
+        self._listdir_cache.flush()
+        for start in xrange(0, len(bulk), limit or 1):
+            chunk = bulk[start:start + limit]
+            failed = self._bulk_delete([path for _, path in chunk])
+            if failed is None:
+                # the request failed as a whole
+                fallback.extend(index for index, _ in chunk)
+                continue
+            for index, path in chunk:
+                errors[index] = failed.get(path)
+
+        for index in sorted(fallback):
+            try:
+                self.remove(paths[index])
+            except EnvironmentError, ex:
+                errors[index] = ex
+        return errors
+
+    def _get_bulk_delete_limit(self):
+        """Return the max number of paths in a bulk-delete request, 0 if not supported."""
+        if self._bulk_delete_limit is None:
+            try:
+                info = self.conn.get_capabilities()
+                self._bulk_delete_limit = int(info.get('bulk_delete', {}).get('max_deletes_per_request', 0))
+            except (ClientException, ValueError, TypeError), ex:
+                logging.debug("bulk delete not available: %s" % ex)
+                self._bulk_delete_limit = 0
+        return self._bulk_delete_limit
+
+    def _list_objects(self, container, dirname, names):
+        """
+        Return a dict with the listing entries (by unicode name) of the
+        directory dirname including names, listing only the range of the
+        directory where they are.
+        """
+        names = sorted(smart_unicode(name, "utf-8") for name in names)
+        prefix = smart_str(dirname) + "/" if dirname else None
+        marker = smart_str(names[0][:-1])
+        last = names[-1]
+        objects = {}
+        while True:
+            _, page = self.conn.get_container(container, prefix=prefix, delimiter="/", marker=marker,
+                                              limit=self.listdir_page_size)
+            for obj in page:
+                if 'name' in obj:
+                    objects[obj['name']] = obj
+            if len(page) < self.listdir_page_size:
+                break
+            marker = smart_str(page[-1].get('name') or page[-1]['subdir'])
+            if smart_unicode(marker, "utf-8") >= last:
+                break
+        return objects
+
+    def _bulk_delete(self, paths):
+        """
+        Delete the utf-8 paths (/container/object) with a bulk-delete request.
+
+        Returns a dict with the error for each path that couldn't be deleted
+        (objects not found are considered deleted), or None if the request
+        failed.
+        """
+        body = "\n".join(quote(path) for path in paths)
+        try:
+            _, resp = self.conn.post_account(headers={'Accept': 'application/json',
+                                                      'Content-Type': 'text/plain'},
+                                             query_string="bulk-delete", data=body)
+            result = json.loads(resp)
+        except TypeError:
+            logging.warning("bulk delete requires a newer swiftclient")
+            self._bulk_delete_limit = 0
+            return None
+        except (ClientException, ValueError), ex:
+            logging.warning("bulk delete failed: %s" % ex)
+            return None
+        logging.debug("bulk delete of %s paths: %r" % (len(paths), result))
+        status = result.get('Response Status', '')
+        errors = result.get('Errors') or []
+        if not errors and not status.startswith("2"):
+            logging.warning("bulk delete failed: %s" % status)
+            return None
+        failed = {}
+        for path, error in errors:
+            code = error.split(" ", 1)[0]
+            error_code = {"401": EACCES, "403": EACCES, "404": ENOENT, "409": ENOTEMPTY}.get(code, EIO)
+            failed[smart_str(unquote(path))] = IOSError(error_code, "Failed to delete %s: %s" % (unquote(path), error))
+        return failed
+
+    def rename(self, src, dst):
+        try:
+            return self._rename(src, dst)
+        finally:
+            for path in (src, dst):
+                self.invalidate(path, recursive=True)
+                self.invalidate(posixpath.dirname(self.abspath(path)))
+
+    @close_when_done
+    @translate_objectstorage_error
+    def _rename(self, src, dst):
+        """
+        Rename a file/directory from src to dst using server-side copies.
+
+        The objects of a directory are copied and deleted concurrently by
+        rename_workers threads. While in progress the destination directory
+        is marked with the source, so if the rename is interrupted running
+        it again resumes it instead of moving src inside dst.
+
+        Raises OSError on error.
+        """
+        src = self.abspath(src)
+        dst = self.abspath(dst)
+        logging.debug("rename %r -> %r" % (src, dst))
+        src_container, src_path = parse_fspath(src)
+        if not src_path:
+            # containers and the root
+            return super(ObjectStorageFS, self).rename(src, dst)
+
+        self._listdir_cache.flush()
+        if src == dst:
+            logging.debug("Renaming %r to itself - doing nothing" % src)
+            return
+        is_dir = self.isdir(src)
+        if not is_dir and not self.isfile(src):
+            raise IOSError(ENOENT, "No such file or directory: %s" % src)
+
+        rename_from = quote(smart_str(src))
+        dst_container, dst_path = parse_fspath(dst)
+        resume = is_dir and dst_path and self._rename_from(dst_container, dst_path) == rename_from
+        if not resume and self.isdir(dst):
+            # move src inside dst
+            dst = posixpath.join(dst, posixpath.basename(src))
+            dst_container, dst_path = parse_fspath(dst)
+            resume = is_dir and self._rename_from(dst_container, dst_path) == rename_from
+        if src == dst:
+            logging.debug("Renaming %r to itself - doing nothing" % src)
+            return
+        if not dst_container or not dst_path:
+            raise IOSError(EACCES, "Can't rename to / from root")
+        if is_dir:
+            if dst.startswith(src + "/"):
+                raise IOSError(EINVAL, "Can't move directory %r inside itself" % src)
+            if self.isfile(dst):
+                raise IOSError(ENOTDIR, "Can't rename directory to file")
+            if not resume and self._has_objects(dst_container, dst_path):
+                raise IOSError(ENOTEMPTY, "Can't rename to non-empty directory: %s" % dst)
+        if not self.isdir(posixpath.dirname(dst)):
+            raise IOSError(ENOENT, "Can't copy %r to %r, destination directory doesn't exist" % (src, dst))
+        self._container_exists(dst_container)
+
+        if is_dir:
+            self._rename_dir(src_container, src_path, dst_container, dst_path, rename_from, resume)
+        else:
+            self._move_object(self.conn, src_container, src_path, dst_container, dst_path)
+        self._listdir_cache.flush()
+
+    def _rename_from(self, container, path):
+        """Return the source of an interrupted rename into the directory path, if any."""
+        try:
+            headers = self.conn.head_object(container, path)
+        except ClientException, ex:
+            if ex.http_status == 404:
+                return None
+            raise
+        return headers.get('x-object-meta-rename-from')
+
+    def _has_objects(self, container, path):
+        """Return True if there are objects inside the directory path."""
+        _, objects = self.conn.get_container(container, prefix=smart_str(path) + "/", limit=1)
+        return bool(objects)
+
+    def _rename_dir(self, src_container, src_path, dst_container, dst_path, rename_from, resume):
+        """Move the directory object and the objects inside src_path to dst_path."""
+        log = paramiko.util.get_logger("paramiko")
+        src = "/%s/%s" % (smart_str(src_container), smart_str(src_path))
+        log.info("rename %r -> %r: %s" % (src, "/%s/%s" % (smart_str(dst_container), smart_str(dst_path)),
+                                         "resuming" if resume else "starting"))
+        self.conn.put_object(dst_container, dst_path, contents=None, content_type="application/directory",
+                             headers={'X-Object-Meta-Rename-From': rename_from})
+
+        src_prefix = smart_str(src_path) + "/"
+        dst_prefix = smart_str(dst_path) + "/"
+        moved_dir = ("%s/%s" % (smart_str(src_container), src_prefix),
+                     "%s/%s" % (smart_str(dst_container), dst_prefix))
+        pool = WorkerPool(self.conn, self.rename_workers)
+        pending = deque()
+        moved = failed = 0
+        last_progress = time.time()
+        try:
+            marker = None
+            while True:
+                _, objects = self.conn.get_container(src_container, prefix=src_prefix, marker=marker,
+                                                     limit=self.listdir_page_size)
+                for obj in objects:
+                    name = smart_str(obj['name'])
+                    new_name = dst_prefix + name[len(src_prefix):]
+                    job = pool.submit(self._move_object, src_container, name, dst_container, new_name,
+                                      obj.get('bytes'), moved_dir)
+                    pending.append((name, job))
+                    # don't queue the whole directory
+                    while len(pending) > 2 * self.rename_workers:
+                        moved, failed = self._rename_result(pending.popleft(), moved, failed)
+                    if time.time() - last_progress >= self.rename_progress_interval:
+                        log.info("rename %r: %s objects moved, %s failed" % (src, moved, failed))
+                        last_progress = time.time()
+                if len(objects) < self.listdir_page_size:
+                    break
+                marker = objects[-1]['name']
+            while pending:
+                moved, failed = self._rename_result(pending.popleft(), moved, failed)
+        finally:
+            for _, job in pending:
+                job.cancelled = True
+            pool.close()
+
+        if failed:
+            log.info("rename %r: %s objects moved, %s failed" % (src, moved, failed))
+            raise IOSError(EIO, "Failed to move %s objects, retry the rename to complete it" % failed)
+
+        # the marker is removed last, so a retry can finish the rename
+        try:
+            self.conn.delete_object(src_container, src_path)
+        except ClientException, ex:
+            if ex.http_status != 404:
+                raise
+        self.conn.put_object(dst_container, dst_path, contents=None, content_type="application/directory")
+        log.info("rename %r: done, %s objects moved" % (src, moved))
+
+    @staticmethod
+    def _rename_result(item, moved, failed):
+        """Wait for a move job and return the updated (moved, failed) counts."""
+        name, job = item
+        try:
+            job.result()
+        except Exception, ex:
+            logging.debug("failed to move %r: %s" % (name, ex))
+            return moved, failed + 1
+        return moved + 1, failed
+
+    @staticmethod
+    def _move_object(conn, src_container, src_path, dst_container, dst_path, size=None, moved_dir=None):
+        """
+        Move an object with a server-side copy and a delete.
+
+        A manifest is moved as a new manifest; if its segments are inside the
+        directory being moved, moved_dir is the (source, destination) prefix
+        of the directory used to point it to their new location. Objects
+        already moved (not found) are ignored.
+        """
+        src_container, src_path = smart_str(src_container), smart_str(src_path)
+        dst_container, dst_path = smart_str(dst_container), smart_str(dst_path)
+        manifest = None
+        if not size:
+            # it may be a manifest
+            try:
+                manifest = conn.head_object(src_container, src_path).get('x-object-manifest')
+            except ClientException, ex:
+                if ex.http_status == 404:
+                    return
+                raise
+        if manifest:
+            manifest = unquote(manifest)
+            if moved_dir and manifest.startswith(moved_dir[0]):
+                # the segments are moved with the manifest
+                manifest = moved_dir[1] + manifest[len(moved_dir[0]):]
+            headers = {'X-Object-Manifest': quote(manifest)}
+        else:
+            headers = {'X-Copy-From': quote("/%s/%s" % (src_container, src_path))}
+        try:
+            conn.put_object(dst_container, dst_path, contents=None, headers=headers)
+            conn.delete_object(src_container, src_path)
+        except ClientException, ex:
+            if ex.http_status != 404:
+                raise
+
+    @translate_objectstorage_error
+    def authenticate(self, username, api_key):
+        """Authenticates and opens the connection"""
+        if not username or not api_key:
+            raise ClientException("username/password required", http_status=401)
+
+        kwargs = dict(authurl=self.authurl, auth_version="1.0", snet=self.snet)
+        tenant_name = None
+
+        if self.keystone:
+            if self.keystone['tenant_separator'] in username:
+                tenant_name, username = username.split(self.keystone['tenant_separator'], 1)
+
+            ks = self.keystone
+            kwargs["auth_version"] = ks['auth_version']
+            if ks['auth_version'] == "3":
+                try:
+                    project_name, project_domain_name = tenant_name.split(self.keystone['domain_separator'], 1)
+                except ValueError:
+                    project_name = tenant_name
+                    project_domain_name = 'default'
+
+                try:
+                    username, user_domain_name = username.split(self.keystone['domain_separator'], 1)
+                except ValueError:
+                    user_domain_name = 'default'
+
+                logging.debug("keystone project_name=%r project_domain_name=%r username=%r user_domain_name=%r" %
+                              (project_name, project_domain_name, username, user_domain_name))
+
+                kwargs["os_options"] = dict(service_type=ks['service_type'],
+                                            endpoint_type=ks['endpoint_type'],
+                                            region_name=ks['region_name'],
+                                            project_name=project_name,
+                                            project_domain_name=project_domain_name,
+                                            user_domain_name=user_domain_name,
+                                            )
+            else:
+                logging.debug("keystone authurl=%r username=%r tenant_name=%r conf=%r" %
+                              (self.authurl, username, tenant_name, self.keystone))
+                kwargs["tenant_name"] = tenant_name
+                kwargs["os_options"] = dict(service_type=ks['service_type'],
+                                            endpoint_type=ks['endpoint_type'],
+                                            region_name=ks['region_name'],
+                                            )
+
+        # the tokens are cached by PooledConnection, not using ProxyConnection's memcache
+        self.conn = PooledConnection(None,
+                                     user=username,
+                                     key=api_key,
+                                     insecure=self.insecure,
+                                     **kwargs
+                                     )
+        # force authentication
+        self.conn.url, self.conn.token = self.conn.get_auth()
+        self.conn.close()
+        # now we are authenticated and we have an username
+        self.username = username
+        self.tenant_name = tenant_name
+
+    def authenticate_token(self, username, url, token):
+        """Opens the connection using an already authenticated session"""
+        tenant_name = None
+        if self.keystone and self.keystone['tenant_separator'] in username:
+            tenant_name, username = username.split(self.keystone['tenant_separator'], 1)
+
+        self.conn = PooledConnection(None,
+                                     preauthurl=url,
+                                     preauthtoken=token,
+                                     insecure=self.insecure,
+                                     )
+        self.conn.url, self.conn.token = url, token
+        self.username = username
+        self.tenant_name = tenant_name
+
+    @close_when_done
+    @translate_objectstorage_error
+    def open(self, path, mode):
+        """
+        Open path with mode, raise IOError on error.
+
+        Objects opened for read get their size from the GET response, using
+        parallel ranged GET requests if enabled. Large files opened for
+        write can upload their segments in parallel.
+        """
+        if 'r' not in mode:
+            # the file will change, the caller invalidates it again on close
+            self.invalidate(path)
+        if 'r' in mode:
+            path = self.abspath(path)
+            container, obj = parse_fspath(path)
+            if ParallelReadFD.workers:
+                logging.debug("open %r mode %r (parallel read)" % (path, mode))
+                return ParallelReadFD(self.conn, container, obj, mode)
+            logging.debug("open %r mode %r" % (path, mode))
+            return StreamingReadFD(self.conn, container, obj, mode)
+        elif ParallelWriteFD.workers and ParallelWriteFD.split_size:
+            path = self.abspath(path)
+            logging.debug("open %r mode %r (parallel write)" % (path, mode))
+            self._listdir_cache.flush(posixpath.dirname(path))
+            container, obj = parse_fspath(path)
+            return ParallelWriteFD(self.conn, container, obj, mode)
+        path = self.abspath(path)
+        logging.debug("open %r mode %r" % (path, mode))
+        self._listdir_cache.flush(posixpath.dirname(path))
+        container, obj = parse_fspath(path)
+        return StreamingWriteFD(self.conn, container, obj, mode)
+
+    @translate_objectstorage_error
+    def open_using(self, conn, path, mode):
+        """
+        Open path for write with mode using conn, that may be used by a
+        different thread, raise IOError on error.
+
+        The caches are not updated, path must be invalidated once closed.
+        """
+        container, obj = parse_fspath(self.abspath(path))
+        logging.debug("open %r mode %r (using %r)" % (path, mode, conn))
+        if ParallelWriteFD.workers and ParallelWriteFD.split_size:
+            return ParallelWriteFD(conn, container, obj, mode)
+        return StreamingWriteFD(conn, container, obj, mode)
+
+    @close_when_done
+    @translate_objectstorage_error
+    def _listdir_page(self, container, prefix, marker, dirs):
+        return self._listdir_page_using(self.conn, container, prefix, marker, dirs)
+
+    def _listdir_page_using(self, conn, container, prefix, marker, dirs):
+        """
+        Return a page of the directory list as (entries, next marker).
+
+        The entries are (utf-8 leafname, stat_result) tuples and the marker
+        is None when there are no more pages. Subdirectories with the same
+        name as a directory object already listed (in dirs) are skipped.
+        """
+        _, objects = conn.get_container(container, prefix=prefix, delimiter="/", marker=marker,
+                                        limit=self.listdir_page_size)
+        logging.debug("listdir page %r marker %r: %s objects" % (prefix, marker, len(objects)))
+
+        next_marker = None
+        if len(objects) >= self.listdir_page_size:
+            last = objects[-1]
+            # the subdir itself is skipped when it's the marker
+            next_marker = last.get('subdir') or last['name']
+
+        entries = []
+        for obj in objects:
+            if 'subdir' in obj:
+                obj['name'] = obj['subdir'].rstrip("/")
+                if obj['name'] in dirs:
+                    continue
+            elif obj.get('content_type') == 'application/directory':
+                dirs.add(obj['name'])
+            elif obj.get('bytes') == 0 and obj.get('hash'):
+                # it may be a manifest, get the real size / hash
+                manifest_obj = conn.head_object(container, obj['name'])
+                if 'x-object-manifest' in manifest_obj:
+                    logging.debug("manifest found: %s" % manifest_obj['x-object-manifest'])
+                    obj['hash'] = manifest_obj['etag']
+                    obj['bytes'] = int(manifest_obj['content-length'])
+            obj['count'] = 1
+            name = posixpath.basename(obj['name']).encode("utf-8")
+            entries.append((name, self._listdir_cache._make_stat(**obj)))
+        return entries, next_marker
+
+    def listdir_with_stat_using(self, conn, path):
+        """
+        Return the directory list of the path with stat objects requested
+        with conn, that may be used by a different thread.
+
+        The caches are not used. The path must be in a container and
+        hide_part_dir not enabled (see can_list_using).
+        """
+        container, obj = parse_fspath(self.abspath(path).rstrip("/"))
+        prefix = smart_str(obj).rstrip("/") + "/" if obj else None
+        dirs = set()
+        entries = []
+        marker = None
+        while True:
+            page, marker = self._listdir_page_using(conn, smart_str(container), prefix, marker, dirs)
+            entries.extend(page)
+            if marker is None:
+                break
+        return [(unicode(name, "utf-8"), stat) for name, stat in sorted(entries)]
+
+    def can_list_using(self, path):
+        """Return True if the path can be listed with listdir_with_stat_using."""
+        return not self.hide_part_dir and bool(parse_fspath(self.abspath(path))[0])
+
+    def iter_listdir_with_stat(self, path):
+        """
+        Return an iterator over the directory list of the path with stat objects.
+
+        Directories are listed in pages of listdir_page_size entries as the
+        iterator is consumed, so big directories are never held in memory.
+        The first page is requested before returning (raising OSError on
+        error), and if it holds the whole directory it fills the cache.
+
+        The root, cached directories and listings that need to see all the
+        entries (hide_part_dir) use listdir_with_stat instead.
+        """
+        path = self.abspath(path).rstrip("/") or "/"
+        logging.debug("iter_listdir_with_stat %r" % path)
+        container, obj = parse_fspath(path)
+        cache = self._listdir_cache
+        if not container or self.hide_part_dir or cache.valid(path):
+            return iter(self.listdir_with_stat(path))
+
+        prefix = smart_str(obj).rstrip("/") + "/" if obj else None
+        dirs = set()
+        entries, marker = self._listdir_page(smart_str(container), prefix, None, dirs)
+        if marker is None:
+            cache.cache = dict(entries)
+            cache.path = path
+            cache.when = time.time()
+            self._cache_listing(path, entries)
+            return iter([(unicode(name, "utf-8"), stat) for name, stat in sorted(cache.cache.iteritems())])
+        return self._iter_listdir_pages(path, smart_str(container), prefix, entries, marker, dirs)
+
+    def _iter_listdir_pages(self, path, container, prefix, entries, marker, dirs):
+        while True:
+            self._cache_listing(path, entries)
+            for name, stat in entries:
+                yield unicode(name, "utf-8"), stat
+            if marker is None:
+                break
+            entries, marker = self._listdir_page(container, prefix, marker, dirs)
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+"""
+Authentication token cache.
+
+Copyright (C) 2011-2019 by Memset Ltd. http://www.memset.com/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import errno
+import hmac
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+from hashlib import sha256
+from time import time
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+import memcache
+
+from ftpcloudfs.utils import smart_str
+
+__all__ = ['TokenCache', 'MemcacheTokenCache', 'FileTokenCache', 'BrokerTokenCache', 'TokenBroker']
+
+
+class TokenCache(object):
+    """
+    Cache of (storage url, auth token) tuples.
+
+    The entries are stored under a salted hash (HMAC-SHA256) of the
+    credentials, so the cache doesn't reveal them, and expire after `ttl`
+    seconds. The salt is random unless provided (eg. to share a memcache
+    among several servers).
+    """
+
+    def __init__(self, ttl, salt=None):
+        self.ttl = ttl
+        self.salt = smart_str(salt) if salt else os.urandom(32)
+
+    def key(self, *credentials):
+        """Return the key for the credentials."""
+        data = "\0".join(smart_str(value or "") for value in credentials)
+        return "tk%s" % hmac.new(self.salt, data, sha256).hexdigest()
+
+    def get(self, key):
+        """Return the (url, token) tuple for key, or None if not found or expired."""
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        """Store the (url, token) tuple for key."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Remove key from the cache."""
+        raise NotImplementedError()
+
+
+class MemcacheTokenCache(TokenCache):
+    """Token cache using memcache."""
+
+    def __init__(self, hosts, ttl, salt=None):
+        super(MemcacheTokenCache, self).__init__(ttl, salt)
+        self.memcache = memcache.Client(hosts)
+
+    def get(self, key):
+        value = self.memcache.get(key)
+        return tuple(value) if value else None
+
+    def set(self, key, value):
+        if not self.memcache.set(key, tuple(value), self.ttl):
+            logging.warning("Failed to store the token")
+
+    def delete(self, key):
+        self.memcache.delete(key)
+
+
+class FileTokenCache(TokenCache):
+    """
+    Token cache using files in a local directory.
+
+    The directory is shared by all the server processes and only the user
+    running the server can access it.
+    """
+
+    def __init__(self, directory, ttl, salt=None):
+        super(FileTokenCache, self).__init__(ttl, salt)
+        self.directory = directory
+        try:
+            os.makedirs(directory, 0700)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as fd:
+                entry = json.load(fd)
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            # truncated or corrupted entry
+            self.delete(key)
+            return None
+        if entry["expires"] <= time():
+            self.delete(key)
+            return None
+        return smart_str(entry["url"]), smart_str(entry["token"])
+
+    def set(self, key, value):
+        url, token = value
+        fd, name = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as tmp:
+                json.dump(dict(url=url, token=token, expires=time()+self.ttl), tmp)
+            os.rename(name, self._path(key))
+        except:
+            os.unlink(name)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+
+class BrokerTokenCache(TokenCache):
+    """
+    Token cache using the broker of the server process (see TokenBroker).
+
+    The broker is reached through the UNIX socket at `path`, with a new
+    connection per request so it can be used from any thread or process.
+    """
+
+    # seconds to wait for the broker
+    timeout = 1.0
+
+    def __init__(self, path, ttl, salt=None):
+        super(BrokerTokenCache, self).__init__(ttl, salt)
+        self.path = path
+
+    def _request(self, **request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request) + "\n")
+            line = sock.makefile("r").readline()
+        finally:
+            sock.close()
+        if not line:
+            raise socket.error(errno.ECONNRESET, "no response from the token broker")
+        return json.loads(line)
+
+    def get(self, key):
+        value = self._request(op="get", key=key).get("value")
+        return tuple(smart_str(item) for item in value) if value else None
+
+    def set(self, key, value):
+        self._request(op="set", key=key, value=list(value))
+
+    def delete(self, key):
+        self._request(op="delete", key=key)
+
+
+class _BrokerRequestHandler(StreamRequestHandler):
+
+    def handle(self):
+        broker = self.server.broker
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op, key = request["op"], request["key"]
+                if op == "get":
+                    response = dict(value=broker.get(key))
+                elif op == "set":
+                    broker.set(key, request["value"])
+                    response = {}
+                elif op == "delete":
+                    broker.delete(key)
+                    response = {}
+                else:
+                    raise ValueError("unknown op %r" % op)
+            except (ValueError, KeyError, TypeError), ex:
+                logging.warning("token broker: invalid request: %s" % ex)
+                return
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class _BrokerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class TokenBroker(object):
+    """
+    Authentication tokens kept in memory by the server process.
+
+    The forked processes store and get the (url, token) tuples with a
+    BrokerTokenCache, so a client reconnecting gets the token of its
+    previous session instead of authenticating again. The entries expire
+    after `ttl` seconds, and only the `size` most recently stored are kept.
+
+    The UNIX socket at `path` is created on start(), once the server runs
+    as its final user; only that user must have access to its directory.
+    """
+
+    def __init__(self, path, ttl, size=10000):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        # key: (expires, value)
+        self.entries = {}
+        self.server = None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] <= time():
+                del self.entries[key]
+                entry = None
+        return entry[1] if entry else None
+
+    def set(self, key, value):
+        now = time()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+            if len(self.entries) > self.size:
+                # drop the expired entries, and the oldest ones if that's not enough
+                entries = sorted((entry for entry in self.entries.items() if entry[1][0] > now),
+                                 key=lambda entry: entry[1][0])
+                self.entries = dict(entries[-self.size:])
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def start(self):
+        """Listen on the socket and serve the requests in background threads."""
+        try:
+            os.unlink(self.path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self.server = _BrokerServer(self.path, _BrokerRequestHandler)
+        self.server.broker = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stop listening and remove the socket."""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
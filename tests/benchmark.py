@@ -0,0 +1,396 @@
+#!/usr/bin/python
+"""
+Benchmark sftpcloudfs against a fake Swift server (see fakeswift.py).
+
+The fake Swift runs in this process and the SFTP server in a forked one,
+configured with the server options given with -o (eg. -o prefork_workers=4).
+Every workload reports the operations per second, the throughput, the p50
+and p99 latency of its operations, and the peak RSS of the server children.
+
+    PYTHONPATH=. python tests/benchmark.py --latency 0.01 -o storage_pool_size=4
+"""
+
+import json
+import os
+import signal
+import sys
+import threading
+from optparse import OptionParser
+from time import time
+
+import paramiko
+
+from sftpcloudfs.server import ObjectStorageSFTPServer
+from fakeswift import FakeSwift
+
+USER = "test:tester"
+KEY = "testing"
+CONTAINER = "bench"
+
+WORKLOADS = ["small_files", "huge_file", "deep_walk", "concurrent", "scp"]
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+class Result(object):
+    """Timings of a workload."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.peak_rss = None
+        self.lock = threading.Lock()
+
+    def timed(self, func, *args, **kwargs):
+        """Call func and record its latency."""
+        start = time()
+        result = func(*args, **kwargs)
+        with self.lock:
+            self.latencies.append(time() - start)
+        return result
+
+    def add_bytes(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def as_dict(self):
+        elapsed = self.elapsed or 1e-9
+        return dict(workload=self.name,
+                    ops=len(self.latencies),
+                    ops_per_sec=len(self.latencies) / elapsed,
+                    mb_per_sec=self.bytes / elapsed / 10**6,
+                    p50_ms=percentile(self.latencies, 50) * 1000,
+                    p99_ms=percentile(self.latencies, 99) * 1000,
+                    elapsed=elapsed,
+                    peak_rss_mb=self.peak_rss / 1024.0 if self.peak_rss is not None else None,
+                    )
+
+
+class RSSMonitor(threading.Thread):
+    """
+    Sample the peak RSS (VmHWM) of the children of a process.
+
+    Only available on Linux; short lived children may be missed.
+    """
+
+    interval = 0.05
+
+    def __init__(self, pid):
+        super(RSSMonitor, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.peak = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.available = os.path.isdir("/proc/%s" % pid)
+
+    def children(self):
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open("/proc/%s/stat" % name) as fd:
+                    # the command may contain spaces, ppid is after it
+                    ppid = int(fd.read().rsplit(")", 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            if ppid == self.pid:
+                yield name
+
+    def sample(self):
+        for child in self.children():
+            try:
+                with open("/proc/%s/status" % child) as fd:
+                    for line in fd:
+                        if line.startswith("VmHWM:"):
+                            rss = int(line.split()[1])
+                            with self.lock:
+                                self.peak = max(self.peak, rss)
+                            break
+            except (IOError, ValueError):
+                continue
+
+    def reset(self):
+        """Return the peak since the last reset, in KB."""
+        self.sample()
+        with self.lock:
+            peak, self.peak = self.peak, None
+        return peak
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+class Benchmark(object):
+
+    def __init__(self, options, server_options):
+        self.options = options
+        self.fake = FakeSwift(latency=options.latency, bandwidth=options.bandwidth)
+        self.fake.store.put_container(CONTAINER)
+
+        # fork the server before any thread is started
+        host_key = paramiko.RSAKey.generate(2048)
+        server = ObjectStorageSFTPServer(("127.0.0.1", 0), host_key=host_key,
+                                         authurl=self.fake.auth_url, **server_options)
+        self.address = server.server_address
+        self.server_pid = os.fork()
+        if not self.server_pid:
+            # in its own group, to stop the workers with it
+            os.setpgid(0, 0)
+            self.fake.server_close()
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(1)
+        server.server_close()
+
+        self.fake.start()
+        self.monitor = RSSMonitor(self.server_pid)
+        if self.monitor.available:
+            self.monitor.start()
+
+    def stop(self):
+        self.monitor.stop()
+        os.killpg(self.server_pid, signal.SIGTERM)
+        os.waitpid(self.server_pid, 0)
+        self.fake.stop()
+
+    def transport(self):
+        transport = paramiko.Transport(self.address)
+        transport.connect(username=USER, password=KEY)
+        return transport
+
+    def sftp(self):
+        transport = self.transport()
+        return transport, paramiko.SFTPClient.from_transport(transport)
+
+    def run(self, name):
+        result = Result(name)
+        self.monitor.reset()
+        start = time()
+        getattr(self, name)(result)
+        result.elapsed = time() - start
+        if self.monitor.available:
+            result.peak_rss = self.monitor.reset()
+        return result
+
+    def _put(self, sftp, path, data, result):
+        def put():
+            with sftp.open(path, "w") as fd:
+                fd.set_pipelined(True)
+                for pos in xrange(0, len(data), 32768):
+                    fd.write(data[pos:pos+32768])
+        result.timed(put)
+        result.add_bytes(len(data))
+
+    def _get(self, sftp, path, result):
+        def get():
+            with sftp.open(path, "r") as fd:
+                fd.prefetch()
+                return fd.read()
+        data = result.timed(get)
+        result.add_bytes(len(data))
+        return data
+
+    def small_files(self, result):
+        """Upload, stat and download many small files in one session."""
+        transport, sftp = self.sftp()
+        data = os.urandom(self.options.file_size)
+        sftp.mkdir("/%s/small" % CONTAINER)
+        names = ["/%s/small/file%06d" % (CONTAINER, i) for i in xrange(self.options.files)]
+        for name in names:
+            self._put(sftp, name, data, result)
+        for name in names:
+            result.timed(sftp.stat, name)
+        for name in names:
+            self._get(sftp, name, result)
+        transport.close()
+
+    def huge_file(self, result):
+        """Upload and download one huge file."""
+        transport, sftp = self.sftp()
+        data = os.urandom(self.options.huge_size * 10**6)
+        name = "/%s/huge" % CONTAINER
+        self._put(sftp, name, data, result)
+        if self._get(sftp, name, result) != data:
+            raise AssertionError("downloaded data doesn't match")
+        transport.close()
+
+    def deep_walk(self, result):
+        """Walk recursively a deep directory tree."""
+        store = self.fake.store
+        dirs = [""]
+        for _ in xrange(self.options.depth):
+            dirs = ["%sdir%d/" % (parent, i) for parent in dirs for i in xrange(self.options.fanout)]
+            for path in dirs:
+                for i in xrange(self.options.fanout):
+                    store.put_object(CONTAINER, "walk/%sfile%d" % (path, i), "x" * 64)
+
+        transport, sftp = self.sftp()
+        pending = ["/%s/walk" % CONTAINER]
+        while pending:
+            path = pending.pop()
+            for attr in result.timed(sftp.listdir_attr, path):
+                if attr.st_mode & 0040000:
+                    pending.append("%s/%s" % (path, attr.filename))
+        transport.close()
+
+    def concurrent(self, result):
+        """Run a mix of operations in concurrent sessions."""
+        data = os.urandom(self.options.file_size)
+        errors = []
+
+        def session(number):
+            try:
+                transport, sftp = self.sftp()
+                base = "/%s/session%d" % (CONTAINER, number)
+                result.timed(sftp.mkdir, base)
+                for i in xrange(self.options.files // self.options.sessions or 1):
+                    name = "%s/file%d" % (base, i)
+                    self._put(sftp, name, data, result)
+                    result.timed(sftp.stat, name)
+                    self._get(sftp, name, result)
+                    result.timed(sftp.listdir_attr, base)
+                    result.timed(sftp.remove, name)
+                transport.close()
+            except Exception, ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=session, args=(i,)) for i in xrange(self.options.sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _scp_get(self, transport, name):
+        channel = transport.open_session()
+        channel.exec_command("scp -f %s" % name)
+        channel.sendall("\0" * 3)
+        received = 0
+        while True:
+            chunk = channel.recv(65536)
+            if not chunk:
+                break
+            received += len(chunk)
+        status = channel.recv_exit_status()
+        channel.close()
+        if status:
+            raise AssertionError("scp download failed with status %s" % status)
+        return received
+
+    def scp(self, result):
+        """Upload and download files with scp."""
+        transport = self.transport()
+        data = os.urandom(self.options.scp_size * 10**6)
+        for i in xrange(self.options.scp_files):
+            name = "/%s/scp%d" % (CONTAINER, i)
+            upload = "C0644 %d scp%d\n%s\0" % (len(data), i, data)
+
+            def put():
+                channel = transport.open_session()
+                channel.exec_command("scp -t %s" % name)
+                channel.recv(1)
+                channel.sendall(upload[:upload.index("\n")+1])
+                channel.recv(1)
+                channel.sendall(upload[upload.index("\n")+1:])
+                channel.recv(1)
+                status = channel.recv_exit_status()
+                channel.close()
+                if status:
+                    raise AssertionError("scp upload failed with status %s" % status)
+            result.timed(put)
+            result.add_bytes(len(data))
+
+            if result.timed(self._scp_get, transport, name) < len(data):
+                raise AssertionError("scp download is incomplete")
+            result.add_bytes(len(data))
+        transport.close()
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [workload ...]",
+                          description="Benchmark sftpcloudfs against a fake Swift server. "
+                                      "Available workloads: %s (default: all)." % ", ".join(WORKLOADS))
+    parser.add_option("-o", dest="server_options", action="append", default=[], metavar="NAME=VALUE",
+                      help="ObjectStorageSFTPServer option (eg. storage_pool_size=4), can be repeated")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds added to each Swift request (default: 0)")
+    parser.add_option("--bandwidth", type="int", default=0,
+                      help="bytes per second per Swift request (default: unlimited)")
+    parser.add_option("--files", type="int", default=200,
+                      help="number of small files (default: 200)")
+    parser.add_option("--file-size", type="int", default=4096,
+                      help="size of the small files in bytes (default: 4096)")
+    parser.add_option("--huge-size", type="int", default=64,
+                      help="size of the huge file in MB (default: 64)")
+    parser.add_option("--depth", type="int", default=4,
+                      help="depth of the directory tree to walk (default: 4)")
+    parser.add_option("--fanout", type="int", default=4,
+                      help="directories and files per directory in the tree (default: 4)")
+    parser.add_option("--sessions", type="int", default=8,
+                      help="number of concurrent sessions (default: 8)")
+    parser.add_option("--scp-files", type="int", default=4,
+                      help="number of files to copy with scp (default: 4)")
+    parser.add_option("--scp-size", type="int", default=8,
+                      help="size of the scp files in MB (default: 8)")
+    parser.add_option("--json", action="store_true", default=False,
+                      help="print the results as JSON")
+    options, workloads = parser.parse_args()
+
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error("unknown workload %r" % workload)
+    if options.sessions < 1:
+        parser.error("sessions must be at least 1")
+
+    server_options = {}
+    for option in options.server_options:
+        name, sep, value = option.partition("=")
+        if not sep:
+            parser.error("invalid server option %r, NAME=VALUE expected" % option)
+        for kind in (int, float):
+            try:
+                value = kind(value)
+                break
+            except ValueError:
+                pass
+        server_options[name.replace("-", "_")] = value
+
+    benchmark = Benchmark(options, server_options)
+    results = []
+    try:
+        for workload in workloads or WORKLOADS:
+            results.append(benchmark.run(workload).as_dict())
+            if not options.json:
+                result = results[-1]
+                rss = "%.1f" % result["peak_rss_mb"] if result["peak_rss_mb"] is not None else "n/a"
+                print "%-12s %7d ops %9.1f ops/s %8.2f MB/s  p50 %8.2f ms  p99 %8.2f ms  peak RSS %s MB" \
+                    % (result["workload"], result["ops"], result["ops_per_sec"], result["mb_per_sec"],
+                       result["p50_ms"], result["p99_ms"], rss)
+                sys.stdout.flush()
+    finally:
+        benchmark.stop()
+
+    if options.json:
+        print json.dumps(dict(server_options=server_options, latency=options.latency,
+                              bandwidth=options.bandwidth, results=results), indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+#!/usr/bin/python
+"""
+Fake OpenStack Object Storage (Swift) server for tests and benchmarks.
+
+Implements enough of the Swift API to run sftpcloudfs against it: v1.0 auth,
+account/container/object listings (prefix, delimiter, marker, limit), object
+GET (single Range), HEAD, PUT (plain and chunked), server-side copy, DLO
+manifests, bulk-delete and /info. The data is kept in memory.
+
+Latency (seconds per request) and bandwidth (bytes per second per request)
+can be configured to emulate a remote cluster.
+
+Run it with: python tests/fakeswift.py [--port 8080] [--latency S] [--bandwidth B]
+"""
+
+import json
+import sys
+import re
+import threading
+import time
+import urllib
+from hashlib import md5
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+
+class Store(object):
+    """Thread-safe in-memory account -> container -> object store."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.stats = {}
+
+    def count(self, method):
+        with self.lock:
+            self.stats[method] = self.stats.get(method, 0) + 1
+
+    def put_container(self, container, policy="Policy-0"):
+        """Create a container, return False if it already exists."""
+        with self.lock:
+            if container in self.containers:
+                return False
+            self.containers[container] = {"objects": {}, "policy": policy}
+        return True
+
+    def put_object(self, container, obj, data, content_type=None, manifest=None, metadata=None):
+        """Store an object, return False if the container doesn't exist."""
+        now = time.time()
+        entry = {"data": data,
+                 "etag": md5(data).hexdigest(),
+                 "content_type": content_type or "application/octet-stream",
+                 "mtime": now,
+                 "last_modified": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) +
+                                  (".%06d" % int((now % 1) * 10**6)),
+                 "manifest": manifest,
+                 "metadata": metadata or {},
+                 }
+        with self.lock:
+            cont = self.containers.get(container)
+            if cont is None:
+                return False
+            cont["objects"][obj] = entry
+        return True
+
+
+class FakeSwiftHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_version = "FakeSwift/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write("%s\n" % (format % args))
+
+    # helpers
+
+    def _throttle(self, size):
+        if self.server.bandwidth and size:
+            time.sleep(float(size) / self.server.bandwidth)
+
+    def _send(self, status, body="", headers=None, head=False):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault("Content-Length", str(len(body)))
+        headers.setdefault("X-Trans-Id", "tx%x" % id(self))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body and not head:
+            self._throttle(len(body))
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                data.append(self.rfile.read(size))
+                self.rfile.readline()
+            return "".join(data)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else ""
+
+    def _metadata(self):
+        """Return the X-Object-Meta-* headers of the request."""
+        return dict((name.title(), value) for name, value in self.headers.items()
+                    if name.lower().startswith("x-object-meta-"))
+
+    def _parse(self):
+        parsed = urlparse(self.path)
+        self.query = dict((k, v[-1].decode("utf-8")) for k, v in parse_qs(parsed.query, keep_blank_values=True).items())
+        parts = [urllib.unquote(p) for p in parsed.path.split("/", 4)[1:]]
+        return parts
+
+    def _authorized(self):
+        return self.headers.get("X-Auth-Token") in self.server.tokens
+
+    # dispatch
+
+    def _handle(self, method):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.store.count(method)
+        parts = self._parse()
+        if parts and parts[0] == "auth":
+            return self.do_auth()
+        if parts and parts[0] == "info":
+            return self._send(200, json.dumps({"swift": {"version": "fake"},
+                                               "bulk_delete": {"max_deletes_per_request": 10000,
+                                                               "max_failed_deletes": 1000}}),
+                              {"Content-Type": "application/json"})
+        if len(parts) < 2 or parts[0] != "v1":
+            self._read_body()
+            return self._send(404)
+        if not self._authorized():
+            self._read_body()
+            return self._send(401, "Unauthorized")
+        container = parts[2] if len(parts) > 2 and parts[2] else None
+        obj = parts[3] if len(parts) > 3 and parts[3] else None
+        if container is None:
+            return getattr(self, "account_%s" % method)()
+        if obj is None:
+            return getattr(self, "container_%s" % method)(container)
+        return getattr(self, "object_%s" % method)(container, obj)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def do_COPY(self):
+        self._handle("COPY")
+
+    # auth
+
+    def do_auth(self):
+        user = self.headers.get("X-Auth-User") or self.headers.get("X-Storage-User")
+        key = self.headers.get("X-Auth-Key") or self.headers.get("X-Storage-Pass")
+        if self.server.users.get(user) != key or key is None:
+            return self._send(401, "Unauthorized")
+        token = "AUTH_tk%s" % md5("%s%s%s" % (user, key, time.time())).hexdigest()
+        self.server.tokens.add(token)
+        self.server.store.count("AUTH")
+        url = "http://%s:%s/v1/AUTH_%s" % (self.server.server_address[0],
+                                          self.server.server_address[1],
+                                          user.split(":")[-1])
+        self._send(200, "", {"X-Storage-Url": url, "X-Auth-Token": token,
+                             "X-Storage-Token": token})
+
+    # listings
+
+    def _listing(self, names, info):
+        """Filter a sorted list of names by the listing query parameters."""
+        prefix = self.query.get("prefix", "")
+        delimiter = self.query.get("delimiter")
+        marker = self.query.get("marker", "")
+        end_marker = self.query.get("end_marker")
+        limit = int(self.query.get("limit", 10000))
+        result = []
+        for name in names:
+            if marker and name <= marker:
+                continue
+            if end_marker and name >= end_marker:
+                break
+            if not name.startswith(prefix):
+                continue
+            if delimiter:
+                pos = name.find(delimiter, len(prefix))
+                if pos >= 0:
+                    subdir = name[:pos+1]
+                    if subdir <= marker:
+                        continue
+                    if not result or result[-1].get("subdir") != subdir:
+                        result.append({"subdir": subdir})
+                    if len(result) >= limit:
+                        break
+                    continue
+            result.append(info(name))
+            if len(result) >= limit:
+                break
+        return result
+
+    def _send_listing(self, listing, headers, head=False):
+        if self.query.get("format") == "json" or "json" in self.headers.get("Accept", ""):
+            body = json.dumps(listing)
+            headers["Content-Type"] = "application/json; charset=utf-8"
+        else:
+            body = "".join("%s\n" % (item.get("subdir") or item["name"]) for item in listing)
+            headers["Content-Type"] = "text/plain; charset=utf-8"
+        status = 200 if listing else 204
+        if status == 204:
+            body = ""
+        self._send(status, body.encode("utf-8") if isinstance(body, unicode) else body, headers, head=head)
+
+    # account
+
+    def account_GET(self, head=False):
+        store = self.server.store
+        with store.lock:
+            items = sorted((name.decode("utf-8"), cont) for name, cont in store.containers.items())
+
+            def info(name):
+                cont = dict(items)[name]
+                return {"name": name, "count": len(cont["objects"]),
+                        "bytes": sum(len(o["data"]) for o in cont["objects"].values())}
+            listing = self._listing([name for name, _ in items], info)
+        headers = {"X-Account-Container-Count": str(len(items))}
+        self._send_listing(listing, headers, head=head)
+
+    def account_HEAD(self):
+        self.account_GET(head=True)
+
+    def account_POST(self):
+        body = self._read_body()
+        if "bulk-delete" not in self.query:
+            return self._send(204)
+        store = self.server.store
+        deleted, not_found, errors = 0, 0, []
+        for line in body.splitlines():
+            line = urllib.unquote(line.strip()).lstrip("/")
+            if not line:
+                continue
+            container, _, obj = line.partition("/")
+            with store.lock:
+                cont = store.containers.get(container)
+                if cont is None:
+                    not_found += 1
+                elif obj:
+                    if cont["objects"].pop(obj, None) is None:
+                        not_found += 1
+                    else:
+                        deleted += 1
+                elif cont["objects"]:
+                    errors.append([urllib.quote("/" + line), "409 Conflict"])
+                else:
+                    del store.containers[container]
+                    deleted += 1
+        status = "400 Bad Request" if errors else "200 OK"
+        result = {"Number Deleted": deleted, "Number Not Found": not_found,
+                  "Response Status": status, "Response Body": "", "Errors": errors}
+        self._send(200, json.dumps(result), {"Content-Type": "application/json"})
+
+    # containers
+
+    def container_PUT(self, container):
+        self._read_body()
+        if self.server.store.put_container(container, self.headers.get("X-Storage-Policy", "Policy-0")):
+            return self._send(201)
+        self._send(202)
+
+    def container_GET(self, container, head=False):
+        store = self.server.store
+        with store.lock:
+            cont = store.containers.get(container)
+            if cont is None:
+                return self._send(404, head=head)
+            objects = sorted((name.decode("utf-8"), o) for name, o in cont["objects"].items())
+            lookup = dict(objects)
+
+            def info(name):
+                o = lookup[name]
+                return {"name": name, "bytes": len(o["data"]), "hash": o["etag"],
+                        "content_type": o["content_type"], "last_modified": o["last_modified"]}
+            listing = [] if head else self._listing([name for name, _ in objects], info)
+            headers = {"X-Container-Object-Count": str(len(objects)),
+                       "X-Container-Bytes-Used": str(sum(len(o["data"]) for _, o in objects)),
+                       "X-Storage-Policy": cont["policy"]}
+        self._send_listing(listing, headers, head=head)
+
+    def container_HEAD(self, container):
+        self.container_GET(container, head=True)
+
+    def container_DELETE(self, container):
+        store = self.server.store
+        with store.lock:
+            cont = store.containers.get(container)
+            if cont is None:
+                return self._send(404)
+            if cont["objects"]:
+                return self._send(409, "Conflict")
+            del store.containers[container]
+        self._send(204)
+
+    def container_POST(self, container):
+        self._read_body()
+        self._send(204)
+
+    # objects
+
+    def _resolve(self, container, obj):
+        """Return (data, meta) for an object, following DLO manifests."""
+        store = self.server.store
+        with store.lock:
+            cont = store.containers.get(container)
+            if cont is None or obj not in cont["objects"]:
+                return None, None
+            meta = cont["objects"][obj]
+            manifest = meta.get("manifest")
+            if not manifest:
+                return meta["data"], meta
+            seg_container, _, prefix = urllib.unquote(manifest).partition("/")
+            seg = store.containers.get(seg_container, {"objects": {}})["objects"]
+            data = "".join(seg[name]["data"] for name in sorted(seg) if name.startswith(prefix))
+            return data, meta
+
+    def _object_headers(self, data, meta):
+        headers = {"Content-Type": meta["content_type"],
+                   "Etag": meta["etag"] if not meta.get("manifest") else '"%s"' % md5(data).hexdigest(),
+                   "Last-Modified": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(meta["mtime"])),
+                   "X-Timestamp": "%.5f" % meta["mtime"],
+                   "Accept-Ranges": "bytes"}
+        if meta.get("manifest"):
+            headers["X-Object-Manifest"] = meta["manifest"]
+        headers.update(meta.get("metadata", {}))
+        return headers
+
+    def object_GET(self, container, obj, head=False):
+        data, meta = self._resolve(container, obj)
+        if data is None:
+            return self._send(404, "Not Found", head=head)
+        headers = self._object_headers(data, meta)
+        status = 200
+        rng = self.headers.get("Range")
+        if rng and not head:
+            match = re.match(r"bytes=(\d*)-(\d*)$", rng.strip())
+            if match:
+                start, end = match.groups()
+                size = len(data)
+                if start == "":
+                    start, end = max(0, size - int(end)), size - 1
+                else:
+                    start = int(start)
+                    end = min(int(end), size - 1) if end else size - 1
+                if start >= size:
+                    headers["Content-Range"] = "bytes */%d" % size
+                    return self._send(416, "", headers)
+                headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+                data = data[start:end+1]
+                status = 206
+        if head:
+            headers["Content-Length"] = str(len(data))
+        self._send(status, data, headers, head=head)
+
+    def object_HEAD(self, container, obj):
+        self.object_GET(container, obj, head=True)
+
+    def object_PUT(self, container, obj):
+        body = self._read_body()
+        self._throttle(len(body))
+        content_type = self.headers.get("Content-Type")
+        manifest = self.headers.get("X-Object-Manifest")
+        copy_from = self.headers.get("X-Copy-From")
+        metadata = self._metadata()
+        if copy_from:
+            src_container, _, src_obj = urllib.unquote(copy_from).lstrip("/").partition("/")
+            data, meta = self._resolve(src_container, src_obj)
+            if data is None:
+                return self._send(404, "Not Found")
+            body = data
+            content_type = content_type or meta["content_type"]
+            metadata = dict(meta["metadata"], **metadata)
+        if not self.server.store.put_object(container, obj, body, content_type, manifest, metadata):
+            return self._send(404, "Not Found")
+        self._send(201, "", {"Etag": md5(body).hexdigest()})
+
+    def object_COPY(self, container, obj):
+        self._read_body()
+        destination = urllib.unquote(self.headers.get("Destination", "")).lstrip("/")
+        dst_container, _, dst_obj = destination.partition("/")
+        data, meta = self._resolve(container, obj)
+        if data is None:
+            return self._send(404, "Not Found")
+        if meta.get("manifest"):
+            data = ""
+        if not self.server.store.put_object(dst_container, dst_obj, data, meta["content_type"], meta.get("manifest"),
+                                            dict(meta["metadata"], **self._metadata())):
+            return self._send(404, "Not Found")
+        self._send(201)
+
+    def object_DELETE(self, container, obj):
+        store = self.server.store
+        with store.lock:
+            cont = store.containers.get(container)
+            if cont is None or cont["objects"].pop(obj, None) is None:
+                return self._send(404, "Not Found")
+        self._send(204)
+
+    def object_POST(self, container, obj):
+        self._read_body()
+        store = self.server.store
+        with store.lock:
+            meta = store.containers.get(container, {}).get("objects", {}).get(obj)
+            if meta is None:
+                return self._send(404, "Not Found")
+            meta["metadata"] = self._metadata()
+        self._send(202)
+
+
+class FakeSwift(ThreadingMixIn, HTTPServer):
+    """Threaded fake Swift server; call start() to serve it in the background."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0), users=None, latency=0.0, bandwidth=0, verbose=False):
+        HTTPServer.__init__(self, address, FakeSwiftHandler)
+        self.users = users or {"test:tester": "testing"}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.verbose = verbose
+        self.tokens = set()
+        self.store = Store()
+        self.thread = None
+
+    @property
+    def auth_url(self):
+        return "http://%s:%s/auth/v1.0" % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(description="Fake Swift server (user test:tester, key testing)")
+    parser.add_option("--port", type="int", default=8080, help="port to listen on (default: 8080)")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds added to each request")
+    parser.add_option("--bandwidth", type="int", default=0, help="bytes per second per request")
+    parser.add_option("--verbose", action="store_true", default=False, help="log the requests")
+    options, _ = parser.parse_args()
+    server = FakeSwift(("127.0.0.1", options.port), latency=options.latency,
+                       bandwidth=options.bandwidth, verbose=options.verbose)
+    print "fake swift listening on %s (test:tester/testing)" % server.auth_url
+    server.serve_forever()
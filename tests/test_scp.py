@@ -259,6 +259,69 @@ class SftpcloudfsTest(unittest.TestCase):
         tail = self.channel.recv(1)
         self.assertEquals(tail, '')
 
+    def test_multiple_files_upload(self):
+        self.channel.exec_command('scp -t -r -d /%s' % self.container)
+
+        ack = self.channel.recv(1)
+        self.assertEquals(ack, '\000')
+
+        self.channel.sendall("D0755 0 multi\n")
+        ack = self.channel.recv(1)
+        self.assertEquals(ack, '\000')
+
+        for name in ('foo', 'bar', 'baz'):
+            self.channel.sendall("C0644 6 %s\n" % name)
+            ack = self.channel.recv(1)
+            self.assertEquals(ack, '\000')
+
+            self.channel.sendall(name + "123\000")
+            ack = self.channel.recv(1)
+            self.assertEquals(ack, '\000')
+
+        self.channel.sendall("E\n")
+        ack = self.channel.recv(1)
+        self.assertEquals(ack, '\000')
+
+        exit_status = self.channel.recv_exit_status()
+        self.assertEquals(exit_status, 0)
+
+        for name in ('foo', 'bar', 'baz'):
+            headers, content = self.conn.get_object(self.container, 'multi/' + name)
+            self.assertEquals(content, name + '123')
+
+    def test_download_tree(self):
+        big = "".join(chr(i % 251) for i in range(300000))
+        self.conn.put_object(self.container, 'foo/a.txt', 'hello')
+        self.conn.put_object(self.container, 'foo/big', big)
+        self.conn.put_object(self.container, 'foo/sub/c.txt', 'abc')
+        self.conn.put_object(self.container, 'foo/z.txt', 'z')
+
+        self.channel.exec_command('scp -fr /%s/foo' % self.container)
+        # an ack per record and per file sent
+        self.channel.send('\000' * 12)
+
+        response = ""
+        while True:
+            data = self.channel.recv(65536)
+            if not data:
+                break
+            response += data
+
+        self.assertEquals(
+            response,
+            'D0755 0 foo\n'
+            'C0644 5 a.txt\nhello\000'
+            'C0644 300000 big\n' + big + '\000'
+            'D0755 0 sub\n'
+            'C0644 3 c.txt\nabc\000'
+            'E\n'
+            'C0644 1 z.txt\nz\000'
+            'E\n'
+        )
+
+        exit_status = self.channel.recv_exit_status()
+        self.assertEquals(exit_status, 0)
+
     def test_file_upload_invalid_size(self):
         self.channel.exec_command('scp -t /%s/foo' % self.container)
 
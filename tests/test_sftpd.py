@@ -5,6 +5,7 @@ import sys
 from time import time
 from swiftclient import client
 import paramiko
+from paramiko.sftp import CMD_REMOVE, CMD_CLOSE
 import stat
 
 from sftpcloudfs.constants import default_ks_tenant_separator as SEP, \
@@ -255,6 +256,21 @@ class SftpcloudfsTest(unittest.TestCase):
         self.sftp.rmdir("potato")
         self.assertEqual(self.sftp.listdir(), [])
 
+    def test_remove_pipelined(self):
+        '''remove several files without waiting for the responses'''
+        names = ["file%02d.txt" % i for i in range(20)] + ["empty.txt"]
+        for name in names:
+            self.create_file(name, "" if name == "empty.txt" else "Hello Moto")
+        self.sftp.mkdir("potato")
+        requests = [self.sftp._async_request(type(None), CMD_REMOVE, self.sftp._adjust_cwd(name))
+                    for name in names + ["missing.txt", "potato"]]
+        for num in requests[:len(names)]:
+            self.sftp._read_response(num)
+        for num in requests[len(names):]:
+            self.assertRaises(EnvironmentError, self.sftp._read_response, num)
+        self.assertEquals(self.sftp.listdir(), ["potato"])
+        self.sftp.rmdir("potato")
+
     def test_rename_file(self):
         '''rename a file'''
         content_string = "Hello Moto" * 100
@@ -341,16 +357,62 @@ class SftpcloudfsTest(unittest.TestCase):
         self.sftp.rmdir("potato")
 
     def test_rename_full_directory(self):
-        '''rename a directory into a directory'''
+        '''rename a directory with contents'''
+        self.sftp.mkdir("potato")
+        self.create_file("potato/something.txt", "p")
+        self.sftp.mkdir("potato/sub")
+        self.create_file("potato/sub/other.txt", "onion")
+        self.assertEquals(sorted(self.sftp.listdir("potato")), ["something.txt", "sub"])
+        self.sftp.rename("potato", "potato2")
+        self.assertRaises(EnvironmentError, self.sftp.stat, "potato")
+        self.assertEquals(sorted(self.sftp.listdir("potato2")), ["something.txt", "sub"])
+        self.assertEquals(self.sftp.listdir("potato2/sub"), ["other.txt"])
+        self.assertEquals(self.sftp.open("potato2/sub/other.txt").read(), "onion")
+        self.sftp.remove("potato2/sub/other.txt")
+        self.sftp.rmdir("potato2/sub")
+        self.sftp.remove("potato2/something.txt")
+        self.sftp.rmdir("potato2")
+
+    def test_rename_full_directory_into_existing_directory(self):
+        '''rename a directory with contents into an existing directory'''
+        self.sftp.mkdir("potato")
+        self.create_file("potato/something.txt", "p")
+        self.sftp.mkdir("potato2")
+        self.sftp.rename("potato", "potato2")
+        self.assertEquals(self.sftp.listdir("potato2"), ["potato"])
+        self.assertEquals(self.sftp.listdir("potato2/potato"), ["something.txt"])
+        self.sftp.remove("potato2/potato/something.txt")
+        self.sftp.rmdir("potato2/potato")
+        self.sftp.rmdir("potato2")
+
+    def test_rename_full_directory_into_self(self):
+        '''rename a directory with contents into its subdirectory - shouldn't work'''
         self.sftp.mkdir("potato")
+        self.sftp.mkdir("potato/sub")
         self.create_file("potato/something.txt", "p")
         try:
-            self.assertEquals(self.sftp.listdir("potato"), ["something.txt"])
-            self.assertRaises(EnvironmentError, self.sftp.rename, "potato", "potato2")
+            self.assertRaises(EnvironmentError, self.sftp.rename, "potato", "potato/sub")
+            self.assertEquals(self.sftp.listdir("potato/sub"), [])
         finally:
             self.sftp.remove("potato/something.txt")
+            self.sftp.rmdir("potato/sub")
             self.sftp.rmdir("potato")
 
+    def test_rename_full_directory_resume(self):
+        '''resume an interrupted directory rename'''
+        self.sftp.mkdir("potato")
+        self.create_file("potato/left.txt", "p")
+        self.conn.put_object(self.container, "potato2", content_type="application/directory", contents="",
+                             headers={"X-Object-Meta-Rename-From": client.quote("/%s/potato" % self.container)})
+        self.conn.put_object(self.container, "potato2/moved.txt", content_type="text/plain", contents="p")
+        self.sftp.rename("potato", "potato2")
+        self.assertRaises(EnvironmentError, self.sftp.stat, "potato")
+        self.assertEquals(sorted(self.sftp.listdir("potato2")), ["left.txt", "moved.txt"])
+        self.assertFalse("x-object-meta-rename-from" in self.conn.head_object(self.container, "potato2"))
+        self.sftp.remove("potato2/left.txt")
+        self.sftp.remove("potato2/moved.txt")
+        self.sftp.rmdir("potato2")
+
     def test_rename_container(self):
         '''rename an empty container'''
         self.sftp.mkdir("/potato")
@@ -444,6 +506,123 @@ class SftpcloudfsTest(unittest.TestCase):
         self.assertEqual(contents, content_string)
         self.sftp.remove("testfile.txt")
 
+    def test_out_of_order_read(self):
+        ''' pipelined reads with out of order offsets '''
+        content_string = "".join(chr(i % 251) for i in xrange(256*1024))
+        self.create_file("testfile.txt", content_string)
+
+        chunks = [(offset, 8192) for offset in xrange(0, len(content_string), 8192)]
+        # swap pairs of requests and jump backwards halfway
+        reordered = []
+        for i in xrange(0, len(chunks), 2):
+            reordered.extend(reversed(chunks[i:i+2]))
+        reordered = reordered[len(reordered)/2:] + reordered[:len(reordered)/2]
+
+        fd = self.sftp.open("testfile.txt", "rb")
+        blocks = list(fd.readv(reordered))
+        fd.close()
+
+        for (offset, length), block in zip(reordered, blocks):
+            self.assertEqual(block, content_string[offset:offset+length])
+        self.sftp.remove("testfile.txt")
+
+    def test_out_of_order_write(self):
+        ''' pipelined writes with out of order offsets '''
+        blocks = ["%05d" % i * 1000 for i in xrange(8)]
+        fd = self.sftp.open("testfile.txt", "w")
+        fd.set_pipelined(True)
+        for i in (1, 3, 2, 0, 5, 4, 7, 6):
+            fd.seek(i * len(blocks[0]))
+            fd.write(blocks[i])
+            fd.flush()
+        fd.close()
+        self.assertEqual(self.read_file("testfile.txt"), "".join(blocks))
+        self.sftp.remove("testfile.txt")
+
+    def test_write_with_gap(self):
+        ''' closing a file with a gap in the writes fails and keeps the old contents '''
+        self.create_file("testfile.txt", "original")
+        fd = self.sftp.open("testfile.txt", "w")
+        fd.write("abc")
+        fd.flush()
+        fd.seek(1000)
+        fd.write("xyz")
+        fd.flush()
+        # paramiko ignores the errors of close
+        self.assertRaises(IOError, self.sftp._request, CMD_CLOSE, fd.handle)
+        fd._closed = True
+        self.assertEqual(self.read_file("testfile.txt"), "original")
+        self.sftp.remove("testfile.txt")
+
+    def test_large_file_read(self):
+        ''' read a file bigger than the parallel download range size '''
+        content_string = "".join(chr(i % 251) for i in xrange(3*10**6+1234))
+        self.create_file("testfile.txt", content_string)
+        self.assertEqual(self.read_file("testfile.txt"), content_string)
+
+        fd = self.sftp.open("testfile.txt", "rb")
+        fd.seek(2*10**6-100)
+        self.assertEqual(fd.read(200), content_string[2*10**6-100:2*10**6+100])
+        fd.close()
+        self.sftp.remove("testfile.txt")
+
+    def test_listdir_paginated(self):
+        '''List a directory with more entries than a listing page'''
+        objs = [ "many/file%04d.txt" % i for i in range(1050) ]
+        objs.append("many/sub/test.txt")
+        for obj in objs:
+            self.conn.put_object(self.container, obj, content_type="text/plain", contents="Hello Moto")
+        self.conn.put_object(self.container, "many/sub", content_type="application/directory", contents="")
+
+        ls = self.sftp.listdir_attr("many")
+        self.assertEqual([ attr.filename for attr in ls ],
+                         [ "file%04d.txt" % i for i in range(1050) ] + ["sub"])
+        self.assertEqual(ls[0].st_size, 10)
+        self.assertTrue(stat.S_ISDIR(ls[-1].st_mode))
+
+        for obj in objs + ["many/sub"]:
+            self.conn.delete_object(self.container, obj)
+
+    def test_listdir_paginated_subdir(self):
+        '''List a directory with a listing page ending on a subdirectory'''
+        # the 1000th entry (a page) is the subdir "g", followed by "g0"
+        objs = [ "many/file%04d.txt" % i for i in range(999) ]
+        objs.extend(["many/g/test.txt", "many/g0"])
+        for obj in objs:
+            self.conn.put_object(self.container, obj, content_type="text/plain", contents="Hello Moto")
+
+        ls = self.sftp.listdir("many")
+        self.assertEqual(ls, [ "file%04d.txt" % i for i in range(999) ] + ["g", "g0"])
+
+        for obj in objs:
+            self.conn.delete_object(self.container, obj)
+
+    @unittest.skipUnless(os.environ.get('SFTPCLOUDFS_TEST_KEY'), "env SFTPCLOUDFS_TEST_KEY not found.")
+    def test_publickey_auth(self):
+        ''' log in with a public key of the authorized keys store '''
+        key = paramiko.RSAKey.from_private_key_file(os.environ['SFTPCLOUDFS_TEST_KEY'])
+        transport = paramiko.Transport((hostname, port))
+        try:
+            transport.connect(username=self.username, pkey=key)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            sftp.chdir("/%s" % self.container)
+            fd = sftp.open("test.txt", "w")
+            fd.write("data")
+            fd.close()
+            self.assertEqual(self.read_file("test.txt"), "data")
+            sftp.remove("test.txt")
+            sftp.close()
+        finally:
+            transport.close()
+
+        # the key is only valid for its username
+        transport = paramiko.Transport((hostname, port))
+        try:
+            self.assertRaises(paramiko.AuthenticationException, transport.connect,
+                              username=self.username + "x", pkey=key)
+        finally:
+            transport.close()
+
     def tearDown(self):
         self.sftp.close()
         self.transport.close()